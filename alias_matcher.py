@@ -0,0 +1,127 @@
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+
+def get_ngrams(text: str, size: int = 3) -> Set[str]:
+    # padded, so short texts and word edges still get n-grams
+    padded = f" {text} "
+    return {padded[index:index + size] for index in range(max(1, len(padded) - size + 1))}
+
+
+def bounded_edit_distance(first: str, second: str, max_distance: int) -> Optional[int]:
+    # Levenshtein distance, None as soon as it's known to be over max_distance.
+    # Only the diagonal band of max_distance width can hold such paths, so only it is calculated
+    if abs(len(first) - len(second)) > max_distance:
+        return None
+    if first == second:
+        return 0
+    over_limit = max_distance + 1
+    previous_row = [index if index <= max_distance else over_limit for index in range(len(second) + 1)]
+    for first_index, first_char in enumerate(first, 1):
+        band_start = max(1, first_index - max_distance)
+        band_end = min(len(second), first_index + max_distance)
+        current_row = [over_limit] * (len(second) + 1)
+        if first_index <= max_distance:
+            current_row[0] = first_index
+        row_min = current_row[0]
+        for second_index in range(band_start, band_end + 1):
+            cell = min(
+                previous_row[second_index] + 1,
+                current_row[second_index - 1] + 1,
+                previous_row[second_index - 1] + (first_char != second[second_index - 1]),
+            )
+            current_row[second_index] = cell
+            if cell < row_min:
+                row_min = cell
+        if row_min > max_distance:
+            return None
+        previous_row = current_row
+    distance = previous_row[-1]
+    return distance if distance <= max_distance else None
+
+
+class FuzzyAliasMatcher:
+    # Works with compare texts (see tumblr.get_compare_text), not with raw replies
+
+    def __init__(self, aliases: Iterable[Tuple[str, str]] = (), threshold: float = 0.8, margin: float = 0.1,
+                 ngram_size: int = 3, max_candidates: int = 5):
+        self.threshold = threshold  # minimal similarity (1 - distance / length) to accept a match
+        self.margin = margin  # how much better than the best other option a match should be
+        self.ngram_size = ngram_size
+        self.max_candidates = max_candidates
+
+        self.__alias_texts: List[str] = list()
+        self.__alias_options: List[str] = list()
+        self.__alias_ngrams: List[Set[str]] = list()
+        self.__known_texts: Set[str] = set()
+        self.__ngram_index: Dict[str, List[int]] = defaultdict(list)
+        self.__matches: Dict[str, Tuple[Optional[str], float]] = dict()
+        for compare_text, option in aliases:
+            self.add_alias(compare_text, option)
+
+    def add_alias(self, compare_text: str, option: str):
+        if not compare_text or compare_text in self.__known_texts:
+            return
+        alias_id = len(self.__alias_texts)
+        alias_ngrams = get_ngrams(compare_text, self.ngram_size)
+        self.__alias_texts.append(compare_text)
+        self.__alias_options.append(option)
+        self.__alias_ngrams.append(alias_ngrams)
+        self.__known_texts.add(compare_text)
+        for ngram in alias_ngrams:
+            self.__ngram_index[ngram].append(alias_id)
+        # cached results might be different with the new alias
+        self.__matches.clear()
+
+    def match(self, compare_text: str) -> Optional[str]:
+        option, _ = self.score(compare_text)
+        return option
+
+    def score(self, compare_text: str) -> Tuple[Optional[str], float]:
+        # Best option with its similarity, no option if it's under the threshold or too close to another one
+        if compare_text not in self.__matches:
+            self.__matches[compare_text] = self.__score(compare_text)
+        return self.__matches[compare_text]
+
+    def __score(self, compare_text: str) -> Tuple[Optional[str], float]:
+        if not compare_text:
+            return None, 0.0
+        max_distance = int(len(compare_text) * (1 - self.threshold) / self.threshold)
+        reply_ngrams = get_ngrams(compare_text, self.ngram_size)
+
+        # An edit changes at most ngram_size n-grams, so an alias within max_distance
+        # has to share at least one of the rarest ngram_size * max_distance + 1 n-grams of the reply
+        rare_ngrams = sorted(reply_ngrams, key=lambda ngram: len(self.__ngram_index.get(ngram, ())))
+        candidates = set()
+        for ngram in rare_ngrams[:self.ngram_size * max_distance + 1]:
+            candidates.update(self.__ngram_index.get(ngram, ()))
+
+        # and it can't lose more than ngram_size * max_distance of them in total
+        min_shared = len(reply_ngrams) - self.ngram_size * max_distance
+        shared_ngrams = Counter()
+        for alias_id in candidates:
+            if abs(len(self.__alias_texts[alias_id]) - len(compare_text)) > max_distance:
+                continue
+            shared = len(reply_ngrams & self.__alias_ngrams[alias_id])
+            if shared >= min_shared:
+                shared_ngrams[alias_id] = shared
+
+        option_scores: Dict[str, float] = dict()
+        for alias_id, _ in shared_ngrams.most_common(self.max_candidates):
+            alias_text = self.__alias_texts[alias_id]
+            distance = bounded_edit_distance(compare_text, alias_text, max_distance)
+            if distance is None:
+                continue
+            similarity = 1 - distance / max(len(compare_text), len(alias_text))
+            option = self.__alias_options[alias_id]
+            option_scores[option] = max(option_scores.get(option, 0.0), similarity)
+
+        if not option_scores:
+            return None, 0.0
+        ranked = sorted(option_scores.items(), key=lambda option_score: option_score[1], reverse=True)
+        best_option, best_score = ranked[0]
+        if best_score < self.threshold:
+            return None, best_score
+        if len(ranked) > 1 and best_score - ranked[1][1] < self.margin:
+            return None, best_score
+        return best_option, best_score
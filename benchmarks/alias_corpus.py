@@ -0,0 +1,65 @@
+import random
+from typing import List, Sequence, Tuple
+
+OPTIONS = (
+    "Open the airlock and step outside",
+    "Check the console for new messages",
+    "Wake up the rest of the crew",
+    "Eat the suspicious space cake",
+)
+FILLERS = ("", "definitely ", "I vote ", "go with ", "hmm, ", "obviously ")
+ENDINGS = ("", "!", "!!", ".", " please", " :)")
+
+
+def make_caption(options: Sequence[str] = OPTIONS) -> str:
+    items = "".join(f"<li>{option}</li>" for option in options)
+    return f"<p>What should we do?</p><ol>{items}</ol>"
+
+
+def make_reply(generator: random.Random, options: Sequence[str]) -> Tuple[str, str]:
+    # (option number, reply) written the ways voters do: numbers, option texts, chatter around them
+    option_index = generator.randrange(len(options))
+    option_number = str(option_index + 1)
+    style = generator.random()
+    if style < 0.3:
+        text = option_number
+    elif style < 0.6:
+        text = options[option_index]
+    else:
+        words = options[option_index].split()
+        text = " ".join(words[:generator.randint(2, len(words))])
+    text = generator.choice(FILLERS) + text + generator.choice(ENDINGS)
+    if generator.random() < 0.5:
+        text = text.upper() if generator.random() < 0.2 else text.capitalize()
+    return option_number, text
+
+
+def add_typo(generator: random.Random, text: str) -> str:
+    if len(text) < 4:
+        return text
+    position = generator.randrange(1, len(text) - 1)
+    typo = generator.random()
+    if typo < 0.33:
+        return text[:position] + text[position + 1:]
+    if typo < 0.66:
+        return text[:position] + text[position + 1] + text[position] + text[position + 2:]
+    return text[:position] + generator.choice("aeiou") + text[position:]
+
+
+def make_aliases(count: int, options: Sequence[str] = OPTIONS, seed: int = 0) -> List[Tuple[str, str]]:
+    # (option number, alias text) as if they were reviewed in earlier posts
+    generator = random.Random(seed)
+    return [make_reply(generator, options) for _ in range(count)]
+
+
+def make_replies(count: int, options: Sequence[str] = OPTIONS, typo_ratio: float = 0.0,
+                 seed: int = 1) -> List[Tuple[str, str]]:
+    # (option number, reply), typo_ratio of them have a typo to exercise fuzzy matching
+    generator = random.Random(seed)
+    replies = list()
+    for _ in range(count):
+        option_number, text = make_reply(generator, options)
+        if generator.random() < typo_ratio:
+            text = add_typo(generator, text)
+        replies.append((option_number, text))
+    return replies
@@ -0,0 +1,110 @@
+import json
+import random
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Sequence
+
+
+def make_notes(count: int, reply_ratio: float = 0.5, replies: Sequence[str] = ("1", "2"),
+               start_timestamp: int = 1_600_000_000, voters: Optional[int] = None, seed: int = 0) -> List[dict]:
+    # Notes newest first, as the API returns them. Timestamps are unique, so before_timestamp paging loses nothing.
+    # Most notes come right after posting, like on real posts
+    generator = random.Random(seed)
+    voters = voters or max(1, count // 2)
+    timestamps = set()
+    while len(timestamps) < count:
+        timestamps.add(start_timestamp + int(generator.random() ** 3 * count * 100))
+    notes = list()
+    for timestamp in sorted(timestamps, reverse=True):
+        note = {"timestamp": timestamp, "blog_name": f"voter-{generator.randrange(voters)}"}
+        if generator.random() < reply_ratio:
+            note["type"] = "reply"
+            note["reply_text"] = generator.choice(replies)
+        else:
+            note["type"] = generator.choice(("like", "reblog"))
+        notes.append(note)
+    return notes
+
+
+class FakeNotesServer:
+    # Serves /v2/blog/<blog>/notes and /v2/blog/<blog>/posts for the given posts on localhost.
+    # latency is added to every response, in seconds
+
+    def __init__(self, posts: List[dict], notes: Dict[int, List[dict]], latency: float = 0.0, page_size: int = 50):
+        self.posts = posts
+        self.notes = notes
+        self.latency = latency
+        self.page_size = page_size
+        self.requests_count = 0
+        self.__lock = threading.Lock()
+        self.__server: Optional[ThreadingHTTPServer] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.__server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def __enter__(self) -> "FakeNotesServer":
+        fake_server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                fake_server.handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        self.__server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.__server.daemon_threads = True
+        threading.Thread(target=self.__server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exception_info):
+        self.__server.shutdown()
+        self.__server.server_close()
+
+    def handle(self, request: BaseHTTPRequestHandler):
+        with self.__lock:
+            self.requests_count += 1
+        if self.latency:
+            time.sleep(self.latency)
+        url = urllib.parse.urlparse(request.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        if url.path.endswith("/notes"):
+            response = self.__get_notes(query)
+        elif url.path.endswith("/posts"):
+            response = self.__get_posts(query)
+        else:
+            response = None
+        status = 200 if response is not None else 404
+        body = json.dumps({"meta": {"status": status, "msg": "OK" if response is not None else "Not Found"},
+                           "response": response or []}).encode()
+        request.send_response(status)
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Content-Length", str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+    def __get_notes(self, query: dict) -> Optional[dict]:
+        notes = self.notes.get(int(query.get("id", 0)))
+        if notes is None:
+            return None
+        before = int(query.get("before_timestamp", 2 ** 62))
+        page = [note for note in notes if note["timestamp"] < before][:self.page_size]
+        response = {"notes": page, "total_notes": len(notes)}
+        if len(page) == self.page_size:
+            response["_links"] = {"next": {"query_params": {
+                "mode": query.get("mode", "all"),
+                "id": query["id"],
+                "before_timestamp": str(page[-1]["timestamp"]),
+            }}}
+        return response
+
+    def __get_posts(self, query: dict) -> dict:
+        if "id" in query:
+            return {"posts": [post for post in self.posts if str(post["id"]) == query["id"]]}
+        offset = int(query.get("offset", 0))
+        limit = int(query.get("limit", 20))
+        return {"posts": self.posts[offset:offset + limit]}
@@ -0,0 +1,290 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional
+
+from benchmarks.alias_corpus import OPTIONS, make_aliases, make_caption, make_replies
+from benchmarks.fake_notes_server import FakeNotesServer, make_notes
+from benchmarks.synthetic_gifs import generate_pages
+
+# run from the repository root: python -m benchmarks.run
+
+
+def measure(function: Callable[[], object], repeat: int,
+            prepare: Optional[Callable[[], None]] = None) -> Dict[str, float]:
+    # wall time of every run in seconds, prepare is called before every run and isn't timed
+    timings = list()
+    for _ in range(repeat):
+        if prepare:
+            prepare()
+        started = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - started)
+    return {
+        "min_seconds": min(timings),
+        "median_seconds": statistics.median(timings),
+        "runs": repeat,
+    }
+
+
+def benchmark_gif_parse(work_dir: str, arguments) -> dict:
+    from image_text_extractor import PageFileParser, summarize_page, summarize_pages
+
+    page_paths = generate_pages(os.path.join(work_dir, "pages"), arguments.pages, arguments.frames,
+                                frame_data_size=arguments.frame_size, trailer_size=arguments.trailer)
+    pages_size = sum(os.path.getsize(page_path) for page_path in page_paths)
+
+    def parse_pages(workers: int, use_mmap: bool = True):
+        if workers == 1:
+            summaries = [summarize_page(page_path, use_mmap) for page_path in page_paths]
+        else:
+            summaries = summarize_pages(page_paths, workers)
+        for summary in summaries:
+            assert summary.error is None, summary.error
+
+    def find_entries():
+        for page_path in page_paths:
+            assert PageFileParser(page_path, lazy=True).find_station_entry()
+
+    return {
+        "pages": len(page_paths),
+        "pages_bytes": pages_size,
+        "stream_1_worker": measure(lambda: parse_pages(1, use_mmap=False), arguments.repeat),
+        "mmap_1_worker": measure(lambda: parse_pages(1), arguments.repeat),
+        f"mmap_{arguments.workers}_workers": measure(lambda: parse_pages(arguments.workers), arguments.repeat),
+        "lazy_station_entry": measure(find_entries, arguments.repeat),
+    }
+
+
+def benchmark_gif_comment(work_dir: str, arguments) -> dict:
+    from image_text_extractor import add_comment_to_gif, add_comments_to_gifs
+
+    source_paths = generate_pages(os.path.join(work_dir, "comment_sources"), arguments.pages, arguments.frames,
+                                  frame_data_size=arguments.frame_size, trailer_size=0)
+    pages_dir = os.path.join(work_dir, "comment_pages")
+    page_paths = [os.path.join(pages_dir, os.path.basename(page_path)) for page_path in source_paths]
+    comment = "Station entry: " + "> examine the console " * 20
+
+    def copy_pages():
+        # every run starts from untouched pages
+        shutil.rmtree(pages_dir, ignore_errors=True)
+        shutil.copytree(os.path.dirname(source_paths[0]), pages_dir)
+
+    def run_fresh(function: Callable[[List[str]], None]) -> Dict[str, float]:
+        return measure(lambda: function(page_paths), arguments.repeat, prepare=copy_pages)
+
+    def append_in_place(page_paths: List[str]):
+        for page_path in page_paths:
+            add_comment_to_gif(page_path, comment)
+
+    def append_atomic(page_paths: List[str]):
+        for page_path in page_paths:
+            add_comment_to_gif(page_path, comment, atomic=True)
+
+    def append_batch(page_paths: List[str]):
+        assert not add_comments_to_gifs({page_path: comment for page_path in page_paths}, atomic=False)
+
+    def append_atomic_batch(page_paths: List[str]):
+        assert not add_comments_to_gifs({page_path: comment for page_path in page_paths})
+
+    return {
+        "pages": len(source_paths),
+        "in_place": run_fresh(append_in_place),
+        "atomic": run_fresh(append_atomic),
+        "batch": run_fresh(append_batch),
+        "atomic_batch": run_fresh(append_atomic_batch),
+    }
+
+
+def benchmark_notes_count(work_dir: str, arguments) -> dict:
+    from database.helper import NotesStore, VotesDatabase
+    from notes_fetcher import AsyncNotesFetcher
+    from tumblr import TumblrPost
+    from tumblr_client import TumblrApiClient
+
+    post = {
+        "id": 1, "id_string": "1", "blog_name": "benchmark", "post_url": "http://localhost/post/1",
+        "timestamp": 1_600_000_000, "caption": make_caption(),
+    }
+    replies = [reply for _, reply in make_replies(500)]
+    notes = make_notes(arguments.notes, arguments.reply_ratio, replies, post["timestamp"])
+    result = {"notes": len(notes), "latency_seconds": arguments.latency}
+
+    with FakeNotesServer([post], {post["id"]: notes}, latency=arguments.latency) as server:
+        client = TumblrApiClient("benchmark", host=server.url, requests_per_hour=10 ** 9, burst=10 ** 9)
+        database = VotesDatabase(config={"url": f"sqlite:///{work_dir}/notes.db"})
+
+        def count(notes_fetcher: Optional[AsyncNotesFetcher] = None, notes_store: Optional[NotesStore] = None):
+            with contextlib.redirect_stdout(io.StringIO()):
+                tumblr_post = TumblrPost(client, post, notes_fetcher, notes_store, options_database=database,
+                                         show_options=False)
+                tumblr_post.count_votes(review=False)
+
+        requests_before = server.requests_count
+        result["serial"] = measure(count, arguments.repeat)
+        result["serial"]["requests"] = (server.requests_count - requests_before) // arguments.repeat
+
+        notes_fetcher = AsyncNotesFetcher("benchmark", host=server.url, concurrency=arguments.concurrency)
+        requests_before = server.requests_count
+        result[f"async_{arguments.concurrency}"] = measure(lambda: count(notes_fetcher), arguments.repeat)
+        result[f"async_{arguments.concurrency}"]["requests"] = \
+            (server.requests_count - requests_before) // arguments.repeat
+
+        notes_store = NotesStore(database)
+        result["store_cold"] = measure(lambda: count(notes_store=notes_store), 1)
+        result["store_warm"] = measure(lambda: count(notes_store=notes_store), arguments.repeat)
+    return result
+
+
+def benchmark_alias_match(work_dir: str, arguments) -> dict:
+    from database.helper import VotesDatabase
+    from tumblr import PostOptions
+
+    database = VotesDatabase(config={"url": f"sqlite:///{work_dir}/aliases.db"})
+    post = {"id": 2, "caption": make_caption()}
+    aliases = make_aliases(arguments.aliases)
+    # every one of them is known, so nothing is asked
+    known_replies = [aliases[index % len(aliases)][1] for index in range(arguments.replies)]
+    fuzzy_replies = make_replies(arguments.replies, typo_ratio=arguments.typo_ratio)
+
+    def load_aliases():
+        with contextlib.redirect_stdout(io.StringIO()):
+            options = PostOptions(post, database=database)
+        for option_number, alias in aliases:
+            if options.match_reply(alias) is None:
+                options.add_alias(option_number, alias)
+        options.save()
+
+    result = {"options": len(OPTIONS), "aliases": len(aliases), "replies": arguments.replies}
+    result["load_aliases"] = measure(load_aliases, 1)
+
+    options = PostOptions(post, database=database)
+    result["exact"] = measure(lambda: [options.get_option_for_reply(reply) for reply in known_replies],
+                              arguments.repeat)
+
+    fuzzy_options = PostOptions(post, database=database, fuzzy_threshold=arguments.fuzzy_threshold)
+    matches = list()
+    result["fuzzy"] = measure(
+        lambda: matches.append([fuzzy_options.match_reply(reply) for _, reply in fuzzy_replies]), 1)
+    matched = [(expected, option) for (expected, _), option in zip(fuzzy_replies, matches[-1]) if option]
+    result["fuzzy"]["matched_ratio"] = len(matched) / len(fuzzy_replies)
+    result["fuzzy"]["wrong_matches"] = sum(expected != option for expected, option in matched)
+    return result
+
+
+def benchmark_frame_stats(work_dir: str, arguments) -> dict:
+    from page_index import PageIndex
+    from page_stats import PageFrameStats
+
+    page_paths = generate_pages(os.path.join(work_dir, "pages"), arguments.pages, arguments.frames,
+                                frame_data_size=arguments.frame_size, trailer_size=arguments.trailer)
+    index = PageIndex(os.path.join(work_dir, "page_index.json"))
+    index.rescan(os.path.dirname(page_paths[0]), arguments.workers)
+    cache_path = os.path.join(work_dir, "page_index_frames.npz")
+
+    def remove_cache():
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
+
+    stats = PageFrameStats.from_index(index, arguments.workers)
+    return {
+        "pages": len(page_paths),
+        "frames": len(stats.frames),
+        "build_cold": measure(lambda: PageFrameStats.from_index(index, arguments.workers), arguments.repeat,
+                              prepare=remove_cache),
+        "build_cached": measure(lambda: PageFrameStats.from_index(index), arguments.repeat),
+        "page_stats": measure(stats.page_stats, arguments.repeat),
+        "act_stats": measure(stats.act_stats, arguments.repeat),
+    }
+
+
+BENCHMARKS = {
+    "gif_parse": benchmark_gif_parse,
+    "gif_comment": benchmark_gif_comment,
+    "notes_count": benchmark_notes_count,
+    "alias_match": benchmark_alias_match,
+    "frame_stats": benchmark_frame_stats,
+}
+
+
+def get_revision() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(previous: dict, current: dict, prefix: str = "") -> List[str]:
+    # median time ratios of every benchmark that's in both results
+    lines = list()
+    for key, value in current.items():
+        if key not in previous:
+            continue
+        if isinstance(value, dict) and "median_seconds" in value:
+            ratio = value["median_seconds"] / max(previous[key]["median_seconds"], 1e-9)
+            lines.append(f"{prefix}{key}: {ratio:.2f}x of the previous time")
+        elif isinstance(value, dict) and isinstance(previous[key], dict):
+            lines.extend(compare_results(previous[key], value, f"{prefix}{key}."))
+    return lines
+
+
+def _parse_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark page parsing, vote counting, alias matching and frame statistics")
+    parser.add_argument("--only", nargs="+", choices=BENCHMARKS.keys(), help="benchmarks to run, all by default")
+    parser.add_argument("-o", "--output", default="benchmark_results.json", help="JSON file for the results")
+    parser.add_argument("--compare", help="earlier results to compare with")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--pages", type=int, default=50)
+    parser.add_argument("--frames", type=int, default=10)
+    parser.add_argument("--frame-size", type=int, default=20000, help="bytes of image data in a frame")
+    parser.add_argument("--trailer", type=int, default=500, help="bytes of station entry after the GIF end")
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--notes", type=int, default=20000)
+    parser.add_argument("--reply-ratio", type=float, default=0.5)
+    parser.add_argument("--latency", type=float, default=0.005, help="seconds the fake API waits per request")
+    parser.add_argument("--concurrency", type=int, default=4, help="async notes fetcher concurrency")
+    parser.add_argument("--aliases", type=int, default=20000)
+    parser.add_argument("--replies", type=int, default=50000)
+    parser.add_argument("--typo-ratio", type=float, default=0.3)
+    parser.add_argument("--fuzzy-threshold", type=float, default=0.8)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    ARGUMENTS = _parse_arguments()
+    RESULTS = {
+        "revision": get_revision(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "started": datetime.now(timezone.utc).isoformat(),
+        "parameters": vars(ARGUMENTS),
+        "benchmarks": dict(),
+    }
+    with tempfile.TemporaryDirectory(prefix="benchmark-") as WORK_DIR:
+        for NAME in ARGUMENTS.only or BENCHMARKS:
+            print(f"Running {NAME}...")
+            BENCHMARK_DIR = os.path.join(WORK_DIR, NAME)
+            os.makedirs(BENCHMARK_DIR)
+            RESULTS["benchmarks"][NAME] = BENCHMARKS[NAME](BENCHMARK_DIR, ARGUMENTS)
+            print(json.dumps(RESULTS["benchmarks"][NAME], indent="\t"))
+
+    with open(ARGUMENTS.output, "w", encoding="utf8") as OUTPUT_FILE:
+        json.dump(RESULTS, OUTPUT_FILE, indent="\t")
+    print(f"Results are saved to {ARGUMENTS.output}")
+
+    if ARGUMENTS.compare:
+        with open(ARGUMENTS.compare, "r", encoding="utf8") as PREVIOUS_FILE:
+            PREVIOUS = json.load(PREVIOUS_FILE)
+        for LINE in compare_results(PREVIOUS["benchmarks"], RESULTS["benchmarks"]):
+            print(LINE)
@@ -0,0 +1,57 @@
+import os
+import random
+import struct
+from typing import List
+
+# a page's station entry, repeated up to the trailer size
+STATION_ENTRY = "STATION ENTRY {index};\n> examine the console\n"
+
+
+def build_gif(frames: int = 10, width: int = 640, height: int = 480, frame_data_size: int = 20000,
+              trailer: bytes = b"", seed: int = 0) -> bytes:
+    # A GIF89a page with a global color table, a looping extension and frames with graphic control extensions.
+    # Every other frame has a local color table, data blocks are random bytes, trailer goes after the GIF end
+    generator = random.Random(seed)
+    gif = bytearray(b"GIF89a")
+    gif += struct.pack("<HH", width, height)
+    gif += bytes((0xF7, 0, 0))  # global color table of 256 colors
+    gif += generator.randbytes(3 * 256)
+    gif += b"\x21\xFF\x0BNETSCAPE2.0\x03\x01\x00\x00\x00"
+    for frame in range(frames):
+        gif += b"\x21\xF9\x04" + bytes((0x04, frame % 7 + 1, 0, 0)) + b"\x00"
+        local_color_table = frame % 2 == 1
+        gif += b"\x2C" + struct.pack("<HHHH", 0, 0, width, height)
+        gif += bytes((0x87 if local_color_table else 0x00,))
+        if local_color_table:
+            gif += generator.randbytes(3 * 256)
+        gif += b"\x08"  # LZW minimum code size
+        data = generator.randbytes(frame_data_size)
+        for block_start in range(0, len(data), 255):
+            block = data[block_start:block_start + 255]
+            gif.append(len(block))
+            gif += block
+        gif.append(0)
+    gif.append(0x3B)
+    gif += trailer
+    return bytes(gif)
+
+
+def build_trailer(index: int, trailer_size: int) -> bytes:
+    if trailer_size <= 0:
+        return b""
+    entry = STATION_ENTRY.format(index=index)
+    return (entry * (trailer_size // len(entry) + 1))[:trailer_size].encode("ascii")
+
+
+def generate_pages(pages_dir: str, pages_count: int = 100, frames: int = 10, width: int = 640, height: int = 480,
+                   frame_data_size: int = 20000, trailer_size: int = 500, seed: int = 0) -> List[str]:
+    # Pages are the same for the same parameters, so runs can be compared
+    os.makedirs(pages_dir, exist_ok=True)
+    page_paths = list()
+    for index in range(pages_count):
+        page_path = os.path.join(pages_dir, f"{index + 1:05d}.gif")
+        page = build_gif(frames, width, height, frame_data_size, build_trailer(index + 1, trailer_size), seed + index)
+        with open(page_path, "wb") as page_file:
+            page_file.write(page)
+        page_paths.append(page_path)
+    return page_paths
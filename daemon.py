@@ -0,0 +1,161 @@
+import json
+import os
+import socket
+import socketserver
+import threading
+from typing import Dict, Optional, TYPE_CHECKING
+
+from metrics import METRICS
+from utils import get_timestamp
+
+if TYPE_CHECKING:
+    from tumblr import TumblrCounter, TumblrPost
+
+DEFAULT_SOCKET_PATH = "data/counter.sock"
+
+
+class CounterDaemon:
+    # Keeps a TumblrCounter warm between requests: the config, the API client, the database engine
+    # and the options of every counted post with their alias indexes.
+    # Requests and responses are JSON objects, one per line, over a Unix socket.
+    # Nothing is asked in the daemon, unknown replies are only counted
+
+    def __init__(self, counter: "TumblrCounter", socket_path: str = DEFAULT_SOCKET_PATH):
+        self.counter = counter
+        self.socket_path = socket_path
+        self.__posts: Dict[int, "TumblrPost"] = dict()
+        self.__post_locks: Dict[int, threading.Lock] = dict()
+        self.__lock = threading.Lock()
+        self.__server: Optional[socketserver.ThreadingUnixStreamServer] = None
+        self.stopping = False
+        self.handlers = {
+            "ping": self.handle_ping,
+            "count": self.handle_count,
+            "batch": self.handle_batch,
+            "reload": self.handle_reload,
+            "stats": self.handle_stats,
+            "shutdown": self.handle_shutdown,
+        }
+
+    def serve(self):
+        self.__remove_stale_socket()
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    if not line.strip():
+                        continue
+                    response = daemon.handle_request(line)
+                    self.wfile.write(json.dumps(response, ensure_ascii=False).encode("utf8") + b"\n")
+                    self.wfile.flush()
+                    if daemon.stopping:
+                        # only once the response is sent, shutdown() waits for serve_forever to return
+                        threading.Thread(target=self.server.shutdown).start()
+                        return
+
+        self.__server = socketserver.ThreadingUnixStreamServer(self.socket_path, Handler)
+        self.__server.daemon_threads = True
+        os.chmod(self.socket_path, 0o600)
+        print(f"Listening on {self.socket_path}")
+        try:
+            self.__server.serve_forever()
+        finally:
+            self.__server.server_close()
+            os.unlink(self.socket_path)
+
+    def handle_request(self, line: bytes) -> dict:
+        try:
+            request = json.loads(line)
+            handler = self.handlers.get(request.get("command"))
+            if handler is None:
+                return {"ok": False, "error": f"Unknown command {request.get('command')!r}"}
+            with METRICS.timer(f"daemon.{request['command']}"):
+                return dict(ok=True, **handler(request))
+        except Exception as error:
+            return {"ok": False, "error": repr(error)}
+
+    def handle_ping(self, _request: dict) -> dict:
+        return dict()
+
+    def handle_count(self, request: dict) -> dict:
+        # the post from the link, the one from the config otherwise
+        if request.get("link"):
+            post = self.counter.fetch_post_by_link(request["link"])
+        else:
+            post = self.counter.fetch_post_by_config()
+        tumblr_post, post_lock = self.__get_post(post)
+        with post_lock:
+            votes = tumblr_post.count_votes(reset_cache=True, review=False)
+            return {
+                "post": tumblr_post.post_link,
+                "counts": votes.counts(),
+                "voters": votes.voters_count,
+                "unknown": tumblr_post.review_queue.replies_count,
+            }
+
+    def handle_batch(self, request: dict) -> dict:
+        result = self.counter.count_blog_posts(
+            request.get("blog") or self.counter.config.blog,
+            after=get_timestamp(request.get("after")),
+            before=get_timestamp(request.get("before")),
+            workers=request.get("workers", 4),
+            review=False,
+        )
+        return {
+            "posts": [
+                {
+                    "post": tumblr_post.post_link,
+                    "counts": tumblr_post.votes.counts(),
+                    "unknown": tumblr_post.review_queue.replies_count,
+                }
+                for tumblr_post in result.posts
+            ],
+            "errors": result.errors,
+        }
+
+    def handle_reload(self, _request: dict) -> dict:
+        # options could be changed by a review in another process
+        with self.__lock:
+            dropped = len(self.__posts)
+            self.__posts.clear()
+        if self.counter.database:
+            from database.helper import POST_OPTIONS_CACHE
+            POST_OPTIONS_CACHE.clear()
+        return {"dropped_posts": dropped}
+
+    def handle_stats(self, _request: dict) -> dict:
+        return {"metrics": METRICS.snapshot(), "api": self.counter.client.metrics.snapshot(),
+                "posts": len(self.__posts)}
+
+    def handle_shutdown(self, _request: dict) -> dict:
+        self.stopping = True
+        return dict()
+
+    def __get_post(self, post: dict):
+        with self.__lock:
+            tumblr_post = self.__posts.get(post['id'])
+            if tumblr_post is None:
+                tumblr_post = self.counter.create_post(post, show_options=False)
+                self.__posts[post['id']] = tumblr_post
+            return tumblr_post, self.__post_locks.setdefault(post['id'], threading.Lock())
+
+    def __remove_stale_socket(self):
+        if not os.path.exists(self.socket_path):
+            return
+        try:
+            send_request(self.socket_path, {"command": "ping"}, timeout=1)
+        except OSError:
+            # nobody listens there
+            os.unlink(self.socket_path)
+        else:
+            raise RuntimeError(f"A daemon is running on {self.socket_path} already")
+
+
+def send_request(socket_path: str, request: dict, timeout: Optional[float] = None) -> dict:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(timeout)
+        client.connect(socket_path)
+        client.sendall(json.dumps(request, ensure_ascii=False).encode("utf8") + b"\n")
+        with client.makefile("rb") as response_file:
+            return json.loads(response_file.readline())
@@ -1,24 +1,266 @@
-from typing import Optional
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from threading import Lock
+from typing import Optional, Iterable, Iterator, Dict, List, Sequence, Tuple
 
 import sqlalchemy
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.engine import Engine
 from sqlalchemy.future import select
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, selectinload
 
 from database import models
+from metrics import METRICS
+
+DEFAULT_URL = "sqlite:///data/database.db"
+DEFAULT_PRAGMAS = {
+    "journal_mode": "WAL",  # readers don't wait for writers
+    "synchronous": "NORMAL",
+    "temp_store": "MEMORY",
+    "cache_size": -64000,  # in KiB
+    "busy_timeout": 5000,  # in ms, concurrent writers wait instead of failing
+}
+
+
+def create_votes_engine(config=None, echo: bool = False) -> Engine:
+    # config is the [database] section of the config, every key is optional:
+    # url, echo, pool_size, max_overflow, pool_timeout and a pragmas table merged over DEFAULT_PRAGMAS
+    config = config or dict()
+    url = config.get("url", DEFAULT_URL)
+    engine_options = dict(echo=config.get("echo", echo), future=True)
+    if url.startswith("sqlite") and ":memory:" not in url:
+        engine_options.update(
+            poolclass=sqlalchemy.pool.QueuePool,
+            pool_size=config.get("pool_size", 5),
+            max_overflow=config.get("max_overflow", 10),
+            pool_timeout=config.get("pool_timeout", 30),
+            # pooled connections are shared between threads of batch runs
+            connect_args=dict(check_same_thread=False),
+        )
+    engine = sqlalchemy.create_engine(url, **engine_options)
+
+    if engine.dialect.name == "sqlite":
+        pragmas = dict(DEFAULT_PRAGMAS)
+        pragmas.update(config.get("pragmas", dict()))
+
+        def set_pragmas(dbapi_connection, _connection_record):
+            cursor = dbapi_connection.cursor()
+            for pragma, value in pragmas.items():
+                cursor.execute(f"PRAGMA {pragma} = {value}")
+            cursor.close()
+
+        sqlalchemy.event.listen(engine, "connect", set_pragmas)
+    return engine
+
+
+@dataclass(frozen=True)
+class StoredPostOptions:
+    # shared through the cache, copy before changing
+    vote_ids: Dict[str, int]  # option number -> VoteOption.id
+    options: Dict[str, List[Tuple[str, str]]]  # option number -> (alias text, compare text), like PostOptions has
+
+
+class PostOptionsCache:
+    # Process-wide LRU of loaded post options, keyed by database url and post id
+
+    def __init__(self, max_size: int = 256):
+        self.max_size = max_size
+        self.__entries: OrderedDict = OrderedDict()
+        self.__lock = Lock()
+
+    def get(self, key: Tuple[str, int]) -> Optional[StoredPostOptions]:
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None:
+                self.__entries.move_to_end(key)
+            return entry
+
+    def put(self, key: Tuple[str, int], entry: StoredPostOptions):
+        with self.__lock:
+            self.__entries[key] = entry
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.max_size:
+                self.__entries.popitem(last=False)
+
+    def invalidate(self, key: Tuple[str, int]):
+        with self.__lock:
+            self.__entries.pop(key, None)
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+
+
+POST_OPTIONS_CACHE = PostOptionsCache()
+
+
+def get_option_full_text(vote_index: int, vote_options: list) -> str:
+    if vote_index == 0:
+        return "Not a vote"
+    vote_text = vote_options[1][0]
+    vote_text = vote_text.replace('\n', '')
+    vote_text = vote_text.replace('“', '')
+    vote_text = vote_text.replace('”', '')
+    return vote_text
+
+
+def is_trivial_alias(compare_text: str, vote_index: int) -> bool:
+    # the option number itself isn't stored as an alias, it's added back on load
+    return vote_index > 0 and compare_text == str(vote_index)
 
 
 class VotesDatabase:
+    # SQLite limits the amount of bound parameters, bulk reads bind at most this many per statement
+    CHUNK_SIZE = 500
 
-    def __init__(self, echo: bool = False):
-        self.engine = sqlalchemy.create_engine("sqlite:///data/database.db", echo=echo, future=True)
+    def __init__(self, echo: bool = False, config=None):
+        self.engine = create_votes_engine(config, echo=echo)
         self.engine: Engine
 
         models.Base.metadata.create_all(self.engine)
+        self.upgrade_schema()
+
+    def upgrade_schema(self):
+        # create_all doesn't add indexes to tables that already exist, missing ones are created here
+        with self.engine.begin() as connection:
+            # the inspector skips indexes on expressions
+            existing_indexes = set(connection.execute(
+                sqlalchemy.text("SELECT name FROM sqlite_master WHERE type = 'index'")
+            ).scalars())
+            if "sqlite_autoindex_tumblr_notes_1" in existing_indexes:
+                # the old unique constraint of notes is a part of the table, SQLite can't drop it
+                self.__rebuild_notes_table(connection)
+                existing_indexes.update(index.name for index in models.TumblrNote.__table__.indexes)
+            for table in models.Base.metadata.sorted_tables:
+                for index in table.indexes:
+                    if index.name in existing_indexes:
+                        continue
+                    if index.name == "ix_vote_aliases_vote_compare":
+                        # older migrations could store the same alias twice
+                        connection.execute(sqlalchemy.text(
+                            "DELETE FROM vote_aliases WHERE id NOT IN "
+                            "(SELECT MIN(id) FROM vote_aliases GROUP BY vote_id, compare_text)"
+                        ))
+                    index.create(connection)
+
+    @staticmethod
+    def __rebuild_notes_table(connection):
+        columns = ", ".join(column.name for column in models.TumblrNote.__table__.columns)
+        connection.execute(sqlalchemy.text("ALTER TABLE tumblr_notes RENAME TO tumblr_notes_old"))
+        models.TumblrNote.__table__.create(connection)
+        connection.execute(sqlalchemy.text(
+            f"INSERT INTO tumblr_notes ({columns}) SELECT {columns} FROM tumblr_notes_old"
+        ))
+        connection.execute(sqlalchemy.text("DROP TABLE tumblr_notes_old"))
 
     def create_session(self) -> Session:
         return Session(self.engine)
 
+    def __cache_key(self, post_id: int) -> Tuple[str, int]:
+        return str(self.engine.url), post_id
+
+    def load_post_options(self, post_id: int) -> Optional[StoredPostOptions]:
+        # the page, its options and their aliases in one eager query, cached for the process
+        cached = POST_OPTIONS_CACHE.get(self.__cache_key(post_id))
+        if cached is not None:
+            METRICS.count("options_cache_hits")
+            return cached
+        METRICS.count("options_cache_misses")
+        with METRICS.timer("db_read.post_options"), self.create_session() as session:
+            post = session.execute(
+                select(models.TumblrPost)
+                .where(models.TumblrPost.post_id == post_id)
+                .options(
+                    selectinload(models.TumblrPost.page)
+                    .selectinload(models.Page.vote_options)
+                    .selectinload(models.VoteOption.aliases)
+                )
+            ).scalar_one_or_none()
+            if post is None or post.page is None:
+                return None
+
+            vote_ids = dict()
+            options = dict()
+            for vote_option in sorted(post.page.vote_options, key=lambda option: option.vote_index):
+                option_number = str(vote_option.vote_index)
+                vote_ids[option_number] = vote_option.id
+                variants = [(option_number, option_number)] if vote_option.vote_index > 0 else list()
+                for alias in sorted(vote_option.aliases, key=lambda option_alias: option_alias.id):
+                    variants.append((alias.vote_text, alias.compare_text))
+                options[option_number] = variants
+        stored = StoredPostOptions(vote_ids=vote_ids, options=options)
+        POST_OPTIONS_CACHE.put(self.__cache_key(post_id), stored)
+        return stored
+
+    def create_post_options(self, post_id: int, options: Dict[str, List[Tuple[str, str]]]):
+        with METRICS.timer("db_write.post_options"), self.create_session() as session:
+            page = models.Page()
+            models.TumblrPost(post_id=post_id, page=page)
+            for option_number, variants in options.items():
+                vote_index = int(option_number)
+                vote_option = models.VoteOption(
+                    vote_index=vote_index,
+                    full_text=get_option_full_text(vote_index, variants),
+                    page=page,
+                )
+                for vote_text, compare_text in variants:
+                    if not is_trivial_alias(compare_text, vote_index):
+                        models.VoteAlias(vote_text=vote_text, compare_text=compare_text, vote=vote_option)
+            session.add(page)
+            session.commit()
+        POST_OPTIONS_CACHE.invalidate(self.__cache_key(post_id))
+
+    def add_post_aliases(self, post_id: int, aliases: Iterable[Tuple[str, str, str]]):
+        # aliases are (option number, alias text, compare text), all are written in one transaction
+        stored = self.load_post_options(post_id)
+        assert stored is not None
+        new_aliases = [
+            (stored.vote_ids[option_number], vote_text, compare_text)
+            for option_number, vote_text, compare_text in aliases
+            if not is_trivial_alias(compare_text, int(option_number))
+        ]
+        with METRICS.timer("db_write.aliases"), self.create_session() as session:
+            self.get_or_create_aliases(session, new_aliases)
+            session.commit()
+        POST_OPTIONS_CACHE.invalidate(self.__cache_key(post_id))
+
+    def save_vote_counts(self, counts: Iterable[Tuple[int, str, int]], counted_at: Optional[int] = None):
+        # counts are (post id, option number, votes), all of them are written in one transaction.
+        # Counts of the same post and option are replaced
+        counted_at = counted_at if counted_at is not None else int(time.time())
+        rows = [
+            dict(post_id=post_id, vote_index=int(option_number), votes=votes, counted_at=counted_at)
+            for post_id, option_number, votes in counts
+        ]
+        if not rows:
+            return
+        statement = sqlite_insert(models.VoteCount)
+        statement = statement.on_conflict_do_update(
+            index_elements=["post_id", "vote_index"],
+            set_=dict(votes=statement.excluded.votes, counted_at=statement.excluded.counted_at),
+        )
+        with METRICS.timer("db_write.vote_counts"), self.create_session() as session:
+            session.execute(statement, rows)
+            session.commit()
+
+    def save_post_votes(self, post_ids: Iterable[int], votes: Iterable[Tuple[int, str, int]]):
+        # votes are (post id, voter, vote index), they replace everything stored for post_ids in one transaction
+        post_ids = list(post_ids)
+        rows = [
+            dict(post_id=post_id, blog_name=blog_name, vote_index=vote_index)
+            for post_id, blog_name, vote_index in votes
+        ]
+        with METRICS.timer("db_write.post_votes"), self.create_session() as session:
+            for chunk_start in range(0, len(post_ids), self.CHUNK_SIZE):
+                session.execute(
+                    sqlalchemy.delete(models.PostVote)
+                    .where(models.PostVote.post_id.in_(post_ids[chunk_start:chunk_start + self.CHUNK_SIZE]))
+                )
+            if rows:
+                session.execute(sqlalchemy.insert(models.PostVote), rows)
+            session.commit()
+
     @staticmethod
     def get_or_create(session: Session, model: models.Base, **kwargs):
         instance = session.query(model).filter_by(**kwargs).first()
@@ -28,3 +270,90 @@ class VotesDatabase:
             instance = model(**kwargs)
             session.add(instance)
             return instance
+
+    @classmethod
+    def get_or_create_many(cls, session: Session, model: models.Base, rows: List[dict],
+                           key_columns: Sequence[str]) -> Dict[Tuple, models.Base]:
+        # Inserts missing rows in one statement and reads all of them back, keyed by key_columns values.
+        # key_columns should be covered by a unique index of the model
+        if not rows:
+            return dict()
+        session.execute(sqlite_insert(model).on_conflict_do_nothing(), rows)
+
+        keys = list({tuple(row[column] for column in key_columns) for row in rows})
+        key_attributes = [getattr(model, column) for column in key_columns]
+        instances = dict()
+        # every key binds a parameter per column
+        chunk_size = max(1, cls.CHUNK_SIZE // len(key_columns))
+        for chunk_start in range(0, len(keys), chunk_size):
+            chunk = keys[chunk_start:chunk_start + chunk_size]
+            for instance in session.execute(
+                select(model).where(sqlalchemy.tuple_(*key_attributes).in_(chunk))
+            ).scalars():
+                instances[tuple(getattr(instance, column) for column in key_columns)] = instance
+        return instances
+
+    @classmethod
+    def get_or_create_aliases(cls, session: Session, aliases: Iterable[Tuple[int, str, str]]) -> Dict[Tuple, models.Base]:
+        # aliases are (vote_id, vote_text, compare_text), the result is keyed by (vote_id, compare_text)
+        rows = [
+            dict(vote_id=vote_id, vote_text=vote_text, compare_text=compare_text)
+            for vote_id, vote_text, compare_text in aliases
+        ]
+        return cls.get_or_create_many(session, models.VoteAlias, rows, ("vote_id", "compare_text"))
+
+
+class NotesStore:
+
+    def __init__(self, database: VotesDatabase):
+        self.database = database
+
+    def get_synced_timestamp(self, post_id: int) -> Optional[int]:
+        # Every note up to this timestamp is stored. Stored notes can be newer than it
+        # when a fetch was interrupted, those are fetched again
+        with self.database.create_session() as session:
+            return session.execute(
+                select(models.TumblrNotesSync.synced_until).filter_by(post_id=post_id)
+            ).scalar()
+
+    @staticmethod
+    def set_synced_timestamp(session: Session, post_id: int, timestamp: int):
+        # never moves back
+        session.execute(
+            sqlite_insert(models.TumblrNotesSync)
+            .values(post_id=post_id, synced_until=timestamp)
+            .on_conflict_do_update(
+                index_elements=[models.TumblrNotesSync.post_id],
+                set_=dict(synced_until=sqlalchemy.func.max(models.TumblrNotesSync.synced_until, timestamp)),
+            )
+        )
+
+    def add_notes(self, session: Session, post_id: int, notes: Iterable[dict]):
+        # already stored notes are skipped
+        rows = [
+            dict(
+                post_id=post_id,
+                timestamp=note['timestamp'],
+                blog_name=note['blog_name'],
+                note_type=note['type'],
+                reply_text=note.get('reply_text'),
+            )
+            for note in notes
+        ]
+        if rows:
+            with METRICS.timer("db_write.notes"):
+                session.execute(sqlite_insert(models.TumblrNote).on_conflict_do_nothing(), rows)
+
+    def iter_notes(self, post_id: int, older_than: Optional[int] = None, batch_size: int = 1000) -> Iterator[dict]:
+        # newest first, same as the API
+        with self.database.create_session() as session:
+            query = select(models.TumblrNote).filter_by(post_id=post_id)
+            if older_than is not None:
+                query = query.where(models.TumblrNote.timestamp < older_than)
+            notes = session.execute(
+                query
+                .order_by(models.TumblrNote.timestamp.desc(), models.TumblrNote.id)
+                .execution_options(yield_per=batch_size)
+            ).scalars()
+            for note in notes:
+                yield note.as_note()
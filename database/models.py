@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, BigInteger
+from sqlalchemy import Column, Integer, String, ForeignKey, BigInteger, Index, func
 from sqlalchemy.orm import declarative_base, relationship
 
 Base = declarative_base()
@@ -18,6 +18,10 @@ class Page(Base):
 
 class VoteOption(Base):
     __tablename__ = "vote_options"
+    __table_args__ = (
+        # covers lookups by page_id as well
+        Index("ix_vote_options_page_vote", "page_id", "vote_index", unique=True),
+    )
 
     id = Column(Integer, primary_key=True)
     vote_index = Column(Integer)  # goes from 0 to 4, 0 - invalid option
@@ -34,10 +38,14 @@ class VoteOption(Base):
 
 class VoteAlias(Base):
     __tablename__ = "vote_aliases"
+    __table_args__ = (
+        # covers lookups by vote_id as well
+        Index("ix_vote_aliases_vote_compare", "vote_id", "compare_text", unique=True),
+    )
 
     id = Column(Integer, primary_key=True)
     vote_text = Column(String)  # human-readable alias text
-    compare_text = Column(String)  # alias text, optimised for comparison
+    compare_text = Column(String, index=True)  # alias text, optimised for comparison
 
     vote_id = Column(Integer, ForeignKey(VoteOption.id))
     vote = relationship(VoteOption, back_populates="aliases")
@@ -51,8 +59,73 @@ class TumblrPost(Base):
 
     post_id = Column(BigInteger, primary_key=True)
 
-    page_id = Column(Integer, ForeignKey(Page.id))
+    page_id = Column(Integer, ForeignKey(Page.id), index=True)
     page = relationship(Page, back_populates="tumblr_post")
 
     def __repr__(self):
         return f"Post ({self.post_id!r}) for page {self.page_id!r}"
+
+
+class TumblrNote(Base):
+    __tablename__ = "tumblr_notes"
+
+    id = Column(Integer, primary_key=True)  # keeps the API order of notes with the same timestamp
+    post_id = Column(BigInteger)
+    timestamp = Column(BigInteger)
+    blog_name = Column(String)
+    note_type = Column(String)
+    reply_text = Column(String)  # only for replies
+
+    def as_note(self) -> dict:
+        # same fields as in the API response
+        note = {'type': self.note_type, 'timestamp': self.timestamp, 'blog_name': self.blog_name}
+        if self.reply_text is not None:
+            note['reply_text'] = self.reply_text
+        return note
+
+    def __repr__(self):
+        return f"Note ({self.note_type!r} by {self.blog_name!r}) for post {self.post_id!r}"
+
+
+# A blog can reply twice in the same second, the text tells the replies apart.
+# NULLs are never equal in a unique index, notes without text are compared by an empty one
+Index(
+    "ix_tumblr_notes_key",
+    TumblrNote.post_id, TumblrNote.timestamp, TumblrNote.blog_name, TumblrNote.note_type,
+    func.coalesce(TumblrNote.reply_text, ""),
+    unique=True,
+)
+
+
+class TumblrNotesSync(Base):
+    __tablename__ = "tumblr_notes_sync"
+
+    post_id = Column(BigInteger, primary_key=True)
+    # every note of the post up to this timestamp is stored, only moves after a complete fetch
+    synced_until = Column(BigInteger)
+
+    def __repr__(self):
+        return f"Notes of post {self.post_id!r} synced until {self.synced_until!r}"
+
+
+class VoteCount(Base):
+    __tablename__ = "vote_counts"
+
+    post_id = Column(BigInteger, primary_key=True)
+    vote_index = Column(Integer, primary_key=True)  # same as VoteOption.vote_index
+    votes = Column(Integer)
+    counted_at = Column(BigInteger)  # unix time of the count
+
+    def __repr__(self):
+        return f"Count of vote {self.vote_index!r} for post {self.post_id!r}: {self.votes!r}"
+
+
+class PostVote(Base):
+    __tablename__ = "post_votes"
+
+    post_id = Column(BigInteger, primary_key=True)
+    blog_name = Column(String, primary_key=True)  # the voter
+    vote_index = Column(Integer)  # same as VoteOption.vote_index
+
+    def __repr__(self):
+        return f"Vote {self.vote_index!r} of {self.blog_name!r} for post {self.post_id!r}"
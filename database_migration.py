@@ -1,37 +1,76 @@
 import json
 import os
 
-from sqlalchemy.orm import Session
+import sqlalchemy
+from dynaconf import Dynaconf
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.future import select
 
 from database.models import Page, VoteOption, VoteAlias, TumblrPost
-from database.helper import VotesDatabase
-
-db = VotesDatabase(echo=True)
-
-for file_name in os.listdir("data"):
-    if not file_name.endswith(".json"):
-        continue
-    with open(f"data/{file_name}", "r", encoding="utf8") as options_file:
-        options = json.load(options_file)
-        post_id = int(file_name.split(".")[0])
-        page = Page()
-        post = TumblrPost(post_id=post_id, page=page)
-        for vote_index, vote_options in options.items():
-            vote_index = int(vote_index)
-            vote_text: str
-            if vote_index == 0:
-                vote_text = "Not a vote"
-            else:
-                vote_text = vote_options[1][0]
-                vote_text = vote_text.replace('\n', '')
-                vote_text = vote_text.replace('“', '')
-                vote_text = vote_text.replace('”', '')
-            vote_option = VoteOption(vote_index=vote_index, full_text=vote_text, page=page)
-            for option_text in vote_options:
-                # skip trivial aliases
-                if option_text[1] in ['1', '2', '3', '4']:
-                    continue
-                alias = VoteAlias(vote_text=option_text[0], compare_text=option_text[1], vote=vote_option)
-        with db.create_session() as session:
-            session.add(page)
-            session.commit()
+from database.helper import VotesDatabase, get_option_full_text, is_trivial_alias
+
+
+def load_options_files(data_dir: str = "data") -> dict:
+    # post id -> options, as PostOptions saves them
+    posts_options = dict()
+    for file_name in os.listdir(data_dir):
+        if not file_name.endswith(".json"):
+            continue
+        post_id = file_name.split(".")[0]
+        if not post_id.isdigit():
+            continue
+        with open(f"{data_dir}/{file_name}", "r", encoding="utf8") as options_file:
+            posts_options[int(post_id)] = json.load(options_file)
+    return posts_options
+
+
+def migrate_options(db: VotesDatabase, posts_options: dict) -> int:
+    # Everything goes in one transaction with executemany inserts, ids are assigned up front.
+    # Posts that are in the database already are skipped. Returns the amount of migrated posts
+    with db.create_session() as session:
+        known_posts = set(session.execute(select(TumblrPost.post_id)).scalars())
+        next_page_id = (session.execute(select(sqlalchemy.func.max(Page.id))).scalar() or 0) + 1
+        next_option_id = (session.execute(select(sqlalchemy.func.max(VoteOption.id))).scalar() or 0) + 1
+
+        page_rows, post_rows, option_rows, alias_rows = list(), list(), list(), list()
+        for post_id, options in posts_options.items():
+            if post_id in known_posts:
+                continue
+            page_id = next_page_id
+            next_page_id += 1
+            page_rows.append(dict(id=page_id))
+            post_rows.append(dict(post_id=post_id, page_id=page_id))
+            for vote_index, vote_options in options.items():
+                vote_index = int(vote_index)
+                option_id = next_option_id
+                next_option_id += 1
+                option_rows.append(dict(
+                    id=option_id,
+                    vote_index=vote_index,
+                    full_text=get_option_full_text(vote_index, vote_options),
+                    page_id=page_id,
+                ))
+                for option_text in vote_options:
+                    # skip trivial aliases
+                    if is_trivial_alias(option_text[1], vote_index):
+                        continue
+                    alias_rows.append(dict(vote_text=option_text[0], compare_text=option_text[1], vote_id=option_id))
+
+        for model, rows in ((Page, page_rows), (TumblrPost, post_rows), (VoteOption, option_rows),
+                            (VoteAlias, alias_rows)):
+            if rows:
+                session.execute(sqlite_insert(model).on_conflict_do_nothing(), rows)
+        session.commit()
+    return len(post_rows)
+
+
+if __name__ == "__main__":
+    CONFIG = Dynaconf(
+        settings_files=[
+            "config.toml"
+        ]
+    )
+    DB = VotesDatabase(config=CONFIG.get("database"))
+    POSTS_OPTIONS = load_options_files()
+    MIGRATED = migrate_options(DB, POSTS_OPTIONS)
+    print(f"Migrated {MIGRATED} of {len(POSTS_OPTIONS)} posts")
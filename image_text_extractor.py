@@ -1,7 +1,14 @@
-import math
+import argparse
+import mmap
 import os
-from dataclasses import dataclass
-from typing import Optional, Union, IO
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, ExitStack
+from dataclasses import dataclass, field
+from typing import Optional, Union, IO, Iterable, Iterator, List, Tuple, Callable, TypeVar, Dict
+
+from metrics import METRICS
 
 
 @dataclass
@@ -34,37 +41,185 @@ class ImageBlockDescriptor:
     color_table_size: int
 
 
-def add_comment_to_gif(file_path: str, comment_ascii: str):
+def _build_comment_extension(comment_ascii: str) -> bytes:
     comment_bytes = comment_ascii.encode('ascii')
-    with open(file_path, "rb") as gif_file:
-        gif_data = gif_file.read()
-    assert gif_data[0:3] == b'GIF'
-    assert gif_data[-1] == 0x3B
-    gif_data = bytearray(gif_data)
-    gif_data[-1] = 0x21  # Extension
-    gif_data.append(0xFE)  # Comment extension type
+    extension = bytearray()
+    extension.append(0x21)  # Extension
+    extension.append(0xFE)  # Comment extension type
     block_size = 0xFF
-    for block_idx in range(math.ceil(len(comment_bytes) / block_size)):
-        data_block = comment_bytes[block_idx*block_size:(block_idx + 1) * block_size]
-        gif_data.append(len(data_block))  # might be less than block_size
-        gif_data = gif_data + data_block
-    gif_data.append(0)  # end of comment data
-    gif_data.append(0x3B)  # gif end
-    with open(file_path, "wb") as gif_file:
-        gif_file.write(gif_data)
+    for block_start in range(0, len(comment_bytes), block_size):
+        data_block = comment_bytes[block_start:block_start + block_size]
+        extension.append(len(data_block))  # might be less than block_size
+        extension += data_block
+    extension.append(0)  # end of comment data
+    extension.append(0x3B)  # gif end
+    return bytes(extension)
+
+
+def _append_comment_extension(file_path: str, comment_extension: bytes):
+    # The extension (with a new trailer) is written over the old trailer in one write, the rest of the file
+    # isn't touched. A crash during the write can leave the page broken, atomic=True works on a copy for that
+    with open(file_path, "r+b") as gif_file:
+        assert gif_file.read(3) == b'GIF'
+        gif_file.seek(-1, os.SEEK_END)
+        assert gif_file.read(1)[0] == 0x3B
+        gif_file.seek(-1, os.SEEK_END)
+        gif_file.write(comment_extension)
+        gif_file.flush()
+        os.fsync(gif_file.fileno())
+
+
+def add_comment_to_gif(file_path: str, comment_ascii: str, atomic: bool = False, sync_dir: bool = True):
+    comment_extension = _build_comment_extension(comment_ascii)
+    if not atomic:
+        _append_comment_extension(file_path, comment_extension)
+        return
+
+    # the comment is added to a copy, which replaces the page only when it's complete
+    page_dir = os.path.dirname(os.path.abspath(file_path))
+    temp_file, temp_path = tempfile.mkstemp(dir=page_dir, suffix=".tmp")
+    os.close(temp_file)
+    try:
+        shutil.copyfile(file_path, temp_path)
+        shutil.copymode(file_path, temp_path)
+        _append_comment_extension(temp_path, comment_extension)
+        os.replace(temp_path, file_path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    if sync_dir:
+        _fsync_dir(page_dir)
+
+
+def _fsync_dir(dir_path: str):
+    dir_file = os.open(dir_path, os.O_RDONLY)
+    try:
+        os.fsync(dir_file)
+    finally:
+        os.close(dir_file)
+
+
+def add_comments_to_gifs(comments: Dict[str, str], atomic: bool = True) -> List[Tuple[str, str]]:
+    # Tags every page with its comment, a failed page doesn't stop the rest. Returns failed pages with errors.
+    # Every page is replaced as a whole by default, so a crash never leaves a half-tagged page.
+    # atomic=False appends in place without copying, for pages that can be restored otherwise
+    errors = list()
+    changed_dirs = set()
+    for file_path, comment_ascii in comments.items():
+        try:
+            add_comment_to_gif(file_path, comment_ascii, atomic=atomic, sync_dir=False)
+        except Exception as error:
+            errors.append((file_path, repr(error)))
+        else:
+            changed_dirs.add(os.path.dirname(os.path.abspath(file_path)))
+    if atomic:
+        # renames are made durable once per directory instead of once per page
+        for page_dir in changed_dirs:
+            _fsync_dir(page_dir)
+    return errors
+
+
+PageBuffer = Union[bytes, bytearray, memoryview, mmap.mmap]
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+class _StreamPageReader:
+    # Fallback reader, goes through the file object field by field
+
+    def __init__(self, page_file: IO):
+        self._page_file = page_file
+
+    @property
+    def size(self) -> int:
+        return os.fstat(self._page_file.fileno()).st_size
+
+    def read_byte(self) -> int:
+        return self._page_file.read(1)[0]
+
+    def read(self, size: int) -> bytes:
+        return self._page_file.read(size)
+
+    def skip(self, size: int) -> None:
+        self._page_file.seek(size, os.SEEK_CUR)
+
+    def seek(self, offset: int) -> None:
+        self._page_file.seek(offset)
+
+    def read_rest(self) -> bytes:
+        return self._page_file.read()
+
+    def read_tail(self, size: int) -> bytes:
+        self._page_file.seek(-size, os.SEEK_END)
+        return self._page_file.read()
+
+    def release(self) -> None:
+        pass
+
+
+class _BufferPageReader:
+    # Walks the whole page in memory (or mapped), skipping is just an offset jump
+
+    def __init__(self, page_data: PageBuffer):
+        self._view = memoryview(page_data)
+        self._offset = 0
+
+    @property
+    def size(self) -> int:
+        return len(self._view)
+
+    def read_byte(self) -> int:
+        byte = self._view[self._offset]
+        self._offset += 1
+        return byte
+
+    def read(self, size: int) -> bytes:
+        # only small header fields are read, copies of them never pin the buffer
+        data = self._view[self._offset:self._offset + size].tobytes()
+        self._offset += size
+        return data
+
+    def skip(self, size: int) -> None:
+        self._offset += size
+
+    def seek(self, offset: int) -> None:
+        self._offset = offset
+
+    def read_rest(self) -> bytes:
+        data = self._view[self._offset:].tobytes()
+        self._offset = len(self._view)
+        return data
+
+    def read_tail(self, size: int) -> bytes:
+        return self._view[len(self._view) - size:].tobytes()
+
+    def release(self) -> None:
+        self._view.release()
 
 
 class PageFileParser:
+    # the station entry is searched in this amount of trailing bytes first, the window grows if it's longer
+    TAIL_WINDOW = 4096
 
-    def __init__(self, page_path: str):
-        self._page_path: str = page_path
-        self._page_file: Optional[IO] = None
+    def __init__(self, page_path: Optional[str] = None, use_mmap: bool = True,
+                 page_data: Optional[PageBuffer] = None, lazy: bool = False):
+        # either a path to the page or its content should be passed
+        assert (page_path is None) != (page_data is None)
+        self._page_path: Optional[str] = page_path
+        self._page_data: Optional[PageBuffer] = page_data
+        self._use_mmap: bool = use_mmap
+        self._reader: Optional[Union[_StreamPageReader, _BufferPageReader]] = None
 
         self.file_info: Optional[FileInfo] = None
         self.app_extensions = list()
         self.image_descriptors = list()
         self.station_entry = None
-        self._extract_data_from_page()
+        if lazy:
+            # only the header, frames and the entry are read on request
+            with self._open_page():
+                self._parse_intro()
+        else:
+            self._extract_data_from_page()
 
     @staticmethod
     def _get_bits(bitfield: int, shift: int, bits_amount: int = 1) -> int:
@@ -76,32 +231,94 @@ class PageFileParser:
     def _read_uint16(number: bytearray):
         return number[0] + 256 * number[1]
 
-    def _read_next_bytes(self, read_len: int = 1) -> Union[int, bytearray]:
+    def _read_next_bytes(self, read_len: int = 1) -> Union[int, bytes]:
         assert read_len > 0
-        assert self._page_file
-        data = self._page_file.read(read_len)
+        assert self._reader
         if read_len == 1:
-            data = data[0]
-        return data
+            return self._reader.read_byte()
+        return self._reader.read(read_len)
+
+    @contextmanager
+    def _open_page(self) -> Iterator[None]:
+        # one page walk at a time, a lazy frame iterator keeps the page open until it's exhausted
+        assert self._reader is None
+        with ExitStack() as stack:
+            if self._page_data is not None:
+                self._reader = _BufferPageReader(self._page_data)
+            else:
+                page_file = stack.enter_context(open(self._page_path, "rb"))
+                # empty files can't be mapped, let the regular checks fail on them
+                if self._use_mmap and os.fstat(page_file.fileno()).st_size > 0:
+                    page_map = stack.enter_context(mmap.mmap(page_file.fileno(), 0, access=mmap.ACCESS_READ))
+                    self._reader = _BufferPageReader(page_map)
+                else:
+                    self._reader = _StreamPageReader(page_file)
+            try:
+                yield
+            finally:
+                self._reader.release()
+                self._reader = None
 
     def _extract_data_from_page(self) -> None:
-        with open(self._page_path, "rb") as self._page_file:
+        with self._open_page():
             self._parse_intro()
+            self.image_descriptors = list(self._walk_blocks())
+            self._parse_station_entry()
 
-            if self.file_info.global_color_table_flag:
-                self._skip_color_table(self.file_info.global_color_table_size)
+    def iter_image_descriptors(self) -> Iterator[ImageBlockDescriptor]:
+        # Reads frames on demand, nothing is stored in image_descriptors
+        with self._open_page():
+            self._parse_intro()
+            yield from self._walk_blocks()
+
+    def find_station_entry(self) -> Optional[str]:
+        with self._open_page():
+            found, entry = self._scan_station_entry()
+            if found:
+                self.station_entry = entry
+            else:
+                # unusual structure, walk all the frames to get to the trailer
+                self._reader.seek(0)
+                self._parse_intro()
+                for _ in self._walk_blocks():
+                    pass
+                self._parse_station_entry()
+        return self.station_entry
+
+    def _walk_blocks(self) -> Iterator[ImageBlockDescriptor]:
+        # Stops on the trailer, the reader is left right after it
+        self.app_extensions = list()
+        if self.file_info.global_color_table_flag:
+            self._skip_color_table(self.file_info.global_color_table_size)
 
+        block_type = self._read_next_bytes()
+        while block_type != 0x3B:
+            if block_type == 0x21:
+                descriptor = self._parse_extension()
+                if descriptor:
+                    yield descriptor
+            else:
+                assert block_type == 0x2C
+                yield self._parse_image_block()
             block_type = self._read_next_bytes()
-            while block_type != 0x3B:
-                if block_type == 0x21:
-                    self._parse_extension()
-                else:
-                    assert block_type == 0x2C
-                    self._parse_image_block()
-                block_type = self._read_next_bytes()
 
-            self._parse_station_entry()
-        self._page_file = None
+    def _scan_station_entry(self) -> Tuple[bool, Optional[str]]:
+        # The trailer always follows a block terminator, and the entry after it is ASCII without NULs,
+        # so the last b'\x00;' with such a tail is the trailer even if the entry has ';' in it
+        page_size = self._reader.size
+        window = self.TAIL_WINDOW
+        while True:
+            window = min(window, page_size)
+            tail = self._reader.read_tail(window)
+            trailer = tail.rfind(b'\x00\x3B')
+            if trailer != -1:
+                entry = tail[trailer + 2:]
+                if not entry.isascii() or b'\x00' in entry:
+                    return False, None
+                return True, entry.decode('ascii') or None
+            if window == page_size or not tail.isascii():
+                return False, None
+            window *= 2
 
     def _parse_intro(self) -> None:
         page_format = self._read_next_bytes(3)
@@ -131,13 +348,13 @@ class PageFileParser:
         )
 
     def _skip_color_table(self, size: int):
-        self._page_file.read(3 * size)
+        self._reader.skip(3 * size)
 
     def _skip_image_data(self):
         code_size = self._read_next_bytes()
-        _ = self._read_data_blocks()
+        self._skip_data_blocks()
 
-    def _parse_extension(self):
+    def _parse_extension(self) -> Optional[ImageBlockDescriptor]:
         extension_type = self._read_next_bytes()
         if extension_type == 0xF9:
             # Graphics Control Extension
@@ -147,10 +364,10 @@ class PageFileParser:
             assert terminator == 0
             image_start = self._read_next_bytes()
             assert image_start == 0x2C
-            self._parse_image_block(GraphicControlExtension(data=extension_data))
+            return self._parse_image_block(GraphicControlExtension(data=extension_data))
         elif extension_type == 0x01:
-            # Plain Text Extension
-            raise NotImplemented()
+            # Plain Text Extension, its header is a sub-block as well
+            self._skip_data_blocks()
         elif extension_type == 0xFF:
             # Application Extension
             header_size = self._read_next_bytes()
@@ -158,13 +375,13 @@ class PageFileParser:
             app_id = self._read_next_bytes(8).decode('ascii')
             app_code = self._read_next_bytes(3).decode('ascii')
             self.app_extensions.append((app_id, app_code))
-            _ = self._read_data_blocks()
+            self._skip_data_blocks()
         else:
+            # Comment Extension, add_comments_to_gifs tags pages with them
             assert extension_type == 0xFE
-            raise NotImplemented()
-            # Comment Extension
+            self._skip_data_blocks()
 
-    def _parse_image_block(self, graphic_control: Optional[GraphicControlExtension] = None):
+    def _parse_image_block(self, graphic_control: Optional[GraphicControlExtension] = None) -> ImageBlockDescriptor:
         image_left_bytes = self._read_next_bytes(2)
         image_top_bytes = self._read_next_bytes(2)
         image_width_bytes = self._read_next_bytes(2)
@@ -181,31 +398,115 @@ class PageFileParser:
             sort_flag=bool(self._get_bits(packed_flags, 5)),
             color_table_size=2 ** (self._get_bits(packed_flags, 0, 3) + 1)
         )
-        self.image_descriptors.append(descriptor)
         if descriptor.local_color_table_flag:
             self._skip_color_table(descriptor.color_table_size)
         self._skip_image_data()
+        return descriptor
 
     def _parse_station_entry(self):
         # read the rest of the file
-        entry = self._page_file.read()
+        entry = self._reader.read_rest()
         if entry:
             self.station_entry = entry.decode('ascii')
 
-    def _read_data_blocks(self):
+    def _skip_data_blocks(self):
         block_size = self._read_next_bytes()
-        data = bytearray()
         while block_size > 0:
-            block_data = self._page_file.read(block_size)
-            data = data + block_data
+            self._reader.skip(block_size)
             block_size = self._read_next_bytes()
-        return data
+
+
+@dataclass
+class PageSummary:
+    page_path: str
+    file_info: Optional[FileInfo] = None
+    frame_count: int = 0
+    app_extensions: List[Tuple[str, str]] = field(default_factory=list)
+    station_entry: Optional[str] = None
+    error: Optional[str] = None
+
+
+def summarize_page(page_path: str, use_mmap: bool = True, page_data: Optional[PageBuffer] = None) -> PageSummary:
+    # Errors are returned instead of raised, so one broken page doesn't stop a batch.
+    # Timings of pages parsed in pool processes stay in those processes
+    try:
+        with METRICS.timer("gif_parse"):
+            if page_data is not None:
+                parser = PageFileParser(page_data=page_data)
+            else:
+                parser = PageFileParser(page_path, use_mmap=use_mmap)
+    except Exception as error:
+        METRICS.count("gif_parse_errors")
+        return PageSummary(page_path=page_path, error=repr(error))
+    return PageSummary(
+        page_path=page_path,
+        file_info=parser.file_info,
+        frame_count=len(parser.image_descriptors),
+        app_extensions=parser.app_extensions,
+        station_entry=parser.station_entry,
+    )
+
+
+def list_pages(pages_dir: str = "pages") -> List[str]:
+    return sorted(
+        entry.path for entry in os.scandir(pages_dir)
+        if entry.is_file() and entry.name.lower().endswith(".gif")
+    )
+
+
+def map_in_pool(function: Callable[[T], R], items: Iterable[T], workers: Optional[int] = None,
+                chunk_size: int = 8) -> Iterator[R]:
+    # Items are sent to the pool in chunks, results are yielded in the order of items.
+    # workers=None uses every core, workers=1 runs everything in this process
+    if workers == 1:
+        yield from map(function, items)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        yield from executor.map(function, items, chunksize=chunk_size)
+
+
+def summarize_pages(page_paths: Iterable[str], workers: Optional[int] = None,
+                    chunk_size: int = 8) -> Iterator[PageSummary]:
+    return map_in_pool(summarize_page, page_paths, workers, chunk_size)
+
+
+def _parse_arguments():
+    parser = argparse.ArgumentParser(description="Extract station entries from the page archive")
+    parser.add_argument("pages_dir", nargs="?", default="pages")
+    parser.add_argument("-j", "--workers", type=int, default=None,
+                        help="amount of parser processes, all cores by default")
+    parser.add_argument("--chunk-size", type=int, default=8,
+                        help="amount of pages sent to a process at once")
+    parser.add_argument("--index", default=None,
+                        help="page index file, only new and changed pages are parsed when it's used")
+    parser.add_argument("--metrics", action="store_true",
+                        help="print parse timings as JSON at the end, pages should be parsed with -j 1")
+    return parser.parse_args()
+
+
+def _get_summaries(arguments) -> Iterable[PageSummary]:
+    if not arguments.index:
+        return summarize_pages(list_pages(arguments.pages_dir), arguments.workers, arguments.chunk_size)
+
+    from page_index import PageIndex
+    index = PageIndex(arguments.index)
+    changed_pages = index.rescan(arguments.pages_dir, arguments.workers, arguments.chunk_size)
+    print(f"{len(changed_pages)} pages parsed, {len(index.entries) - len(changed_pages)} taken from the index\n")
+    return index.summaries()
 
 
 if __name__ == "__main__":
-    for page in os.listdir("pages"):
-        print(page)
-        parser = PageFileParser(f"pages/{page}")
-        print(parser.station_entry or "--- NO STATION ENTRY ---")
+    ARGUMENTS = _parse_arguments()
+    METRICS.enabled = ARGUMENTS.metrics
+    ERRORS = list()
+    for SUMMARY in _get_summaries(ARGUMENTS):
+        print(os.path.basename(SUMMARY.page_path))
+        if SUMMARY.error:
+            ERRORS.append(SUMMARY)
+            print(f"--- ERROR: {SUMMARY.error} ---")
+        else:
+            print(SUMMARY.station_entry or "--- NO STATION ENTRY ---")
         print("")
-    print("Done")
+    print(f"Done, {len(ERRORS)} pages failed" if ERRORS else "Done")
+    if ARGUMENTS.metrics:
+        print(METRICS.to_json_line())
@@ -1,20 +1,190 @@
-from dynaconf import Dynaconf
-from tumblr import TumblrCounter
-
-CONFIG = Dynaconf(
-    settings_files=[
-        "config.toml"
-    ]
-)
-
-TUMBLR_COUNTER = TumblrCounter(config=CONFIG.tumblr)
-TUMBLR_POST = TUMBLR_COUNTER.get_post_by_config()
-VOTES = TUMBLR_POST.count_votes()
-
-print("\nTumblr: " + ", ".join(
-    [
-        f'{OPTION} - {len(OPTION_VOTES)}'
-        for OPTION, OPTION_VOTES in VOTES.votes.items()
-        if OPTION_VOTES and OPTION != "0"
-    ]
-))
+import argparse
+import sys
+
+from utils import format_counts
+
+# Heavy modules (dynaconf, the counter with its HTTP and database dependencies) are imported
+# only by the commands that need them, "request" talks to a running daemon with the standard library alone
+
+DEFAULT_CONFIG = "config.toml"
+
+
+def load_config(config_path: str):
+    from dynaconf import Dynaconf
+    return Dynaconf(
+        settings_files=[
+            config_path
+        ]
+    )
+
+
+def create_counter(config):
+    from tumblr import TumblrCounter
+    return TumblrCounter(config=config.tumblr, database_config=config.get("database"))
+
+
+def run_count(arguments, config):
+    counter = create_counter(config)
+    if arguments.link:
+        tumblr_post = counter.get_post_by_link(arguments.link)
+    else:
+        tumblr_post = counter.get_post_by_config()
+    votes = tumblr_post.count_votes()
+    print("\nTumblr: " + format_counts(votes.counts()))
+    print(f"\nAPI: {counter.client.metrics.summary()}")
+
+
+def run_batch(arguments, config):
+    from utils import get_timestamp
+    from votes_export import export_votes_csv, export_votes_parquet
+
+    batch_config = config.get("batch") or dict()
+    counter = create_counter(config)
+    # every poll post of the blog in [after, before)
+    batch = counter.count_blog_posts(
+        arguments.blog or config.tumblr.blog,
+        after=get_timestamp(arguments.after or batch_config.get("after")),
+        before=get_timestamp(arguments.before or batch_config.get("before")),
+        workers=arguments.workers or batch_config.get("workers", 4),
+    )
+    print(f"\nCounted {len(batch.posts)} posts, {len(batch.errors)} failed")
+    for tumblr_post in batch.posts:
+        print(f"{tumblr_post.post_link}: " + format_counts(tumblr_post.votes.counts()))
+
+    posts_votes = {tumblr_post.post['id']: tumblr_post.votes for tumblr_post in batch.posts}
+    if batch_config.get("export_csv"):
+        export_votes_csv(batch_config["export_csv"], posts_votes)
+    if batch_config.get("export_parquet"):
+        export_votes_parquet(batch_config["export_parquet"], posts_votes)
+    print(f"\nAPI: {counter.client.metrics.summary()}")
+
+
+def run_watch(arguments, config):
+    from watch import PollWatcher
+
+    watch_config = config.get("watch") or dict()
+    counter = create_counter(config)
+    if arguments.link:
+        post = counter.fetch_post_by_link(arguments.link)
+    else:
+        post = counter.fetch_post_by_config()
+    watcher = PollWatcher(
+        counter.create_post(post, show_options=False),
+        min_interval=arguments.min_interval or watch_config.get("min_interval", 5.0),
+        max_interval=arguments.max_interval or watch_config.get("max_interval", 120.0),
+        backoff=watch_config.get("backoff", 1.5),
+        output_path=arguments.output or watch_config.get("output"),
+        http_port=arguments.port or watch_config.get("http_port"),
+    )
+    watcher.run()
+    print(f"\nAPI: {counter.client.metrics.summary()}")
+
+
+def run_daemon(arguments, config):
+    from daemon import CounterDaemon
+    CounterDaemon(create_counter(config), arguments.socket).serve()
+
+
+def run_request(arguments) -> int:
+    from daemon import send_request
+
+    request = {"command": arguments.request_command}
+    if arguments.link:
+        request["link"] = arguments.link
+    for key in ("blog", "after", "before", "workers"):
+        if getattr(arguments, key):
+            request[key] = getattr(arguments, key)
+    try:
+        response = send_request(arguments.socket, request)
+    except OSError as error:
+        print(f"Can't reach the daemon on {arguments.socket}: {error}", file=sys.stderr)
+        return 1
+    if not response.pop("ok"):
+        print(f"Daemon error: {response['error']}", file=sys.stderr)
+        return 1
+
+    if arguments.request_command == "count":
+        print(f"{response['post']}: {format_counts(response['counts'])} ({response['unknown']} unknown)")
+    elif arguments.request_command == "batch":
+        for post in response["posts"]:
+            print(f"{post['post']}: {format_counts(post['counts'])} ({post['unknown']} unknown)")
+        print(f"Counted {len(response['posts'])} posts, {len(response['errors'])} failed")
+    elif response:
+        import json
+        print(json.dumps(response, indent="\t", ensure_ascii=False))
+    return 0
+
+
+def _parse_arguments(argv=None):
+    from daemon import DEFAULT_SOCKET_PATH
+
+    parser = argparse.ArgumentParser(description="Count votes in Tumblr post replies")
+    parser.add_argument("-c", "--config", default=DEFAULT_CONFIG)
+    parser.set_defaults(link=None, blog=None, after=None, before=None, workers=None, output=None, port=None,
+                        min_interval=None, max_interval=None)
+    commands = parser.add_subparsers(dest="command")
+
+    count_parser = commands.add_parser("count", help="count one post")
+    count_parser.add_argument("--link", help="post link, post_link or the latest post of the blog by default")
+
+    def add_batch_arguments(batch_parser):
+        batch_parser.add_argument("--blog", help="blog from the config by default")
+        batch_parser.add_argument("--after", help="ISO date or unix time, [batch] after by default")
+        batch_parser.add_argument("--before", help="ISO date or unix time, [batch] before by default")
+        batch_parser.add_argument("-j", "--workers", type=int)
+
+    add_batch_arguments(commands.add_parser("batch", help="count every poll post of the blog, "
+                                                        "the default if the config has a [batch] section"))
+
+    watch_parser = commands.add_parser("watch", help="keep counting one post as new notes come")
+    watch_parser.add_argument("--link", help="post link, post_link or the latest post of the blog by default")
+    watch_parser.add_argument("-o", "--output", help="JSON file with the latest results, [watch] output by default")
+    watch_parser.add_argument("--port", type=int, help="serve the latest results over HTTP on this port")
+    watch_parser.add_argument("--min-interval", type=float, help="seconds between checks while votes come")
+    watch_parser.add_argument("--max-interval", type=float, help="seconds between checks while nothing happens")
+
+    daemon_parser = commands.add_parser("daemon", help="keep the counter warm and serve requests")
+    daemon_parser.add_argument("--socket", default=DEFAULT_SOCKET_PATH)
+
+    request_parser = commands.add_parser("request", help="send a request to a running daemon")
+    request_parser.add_argument("--socket", default=DEFAULT_SOCKET_PATH)
+    request_commands = request_parser.add_subparsers(dest="request_command", required=True)
+    request_count_parser = request_commands.add_parser("count")
+    request_count_parser.add_argument("--link")
+    add_batch_arguments(request_commands.add_parser("batch"))
+    for request_command in ("ping", "reload", "stats", "shutdown"):
+        request_commands.add_parser(request_command)
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    arguments = _parse_arguments(argv)
+    if arguments.command == "request":
+        return run_request(arguments)
+
+    config = load_config(arguments.config)
+    if not arguments.command:
+        arguments.command = "batch" if config.get("batch") else "count"
+
+    from metrics import configure_metrics, profiling, publish_metrics, publish_metrics_periodically
+    configure_metrics(config.get("metrics"))
+    stop_publishing = publish_metrics_periodically(config.get("metrics"))
+    try:
+        with profiling(config.get("metrics")):
+            if arguments.command == "batch":
+                run_batch(arguments, config)
+            elif arguments.command == "watch":
+                run_watch(arguments, config)
+            elif arguments.command == "daemon":
+                run_daemon(arguments, config)
+            else:
+                run_count(arguments, config)
+    finally:
+        stop_publishing()
+    publish_metrics(config.get("metrics"))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,222 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Callable, Dict, Iterator, List, Optional
+
+METRIC_PREFIX = "anthrofractal"
+# returned by timers while metrics are disabled, entering it costs next to nothing
+NULL_TIMER = nullcontext()
+
+
+class StageTimer:
+    __slots__ = ("metrics", "stage", "started")
+
+    def __init__(self, metrics: "Metrics", stage: str):
+        self.metrics = metrics
+        self.stage = stage
+        self.started = 0.0
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exception_info):
+        self.metrics.observe(self.stage, time.perf_counter() - self.started)
+
+
+class Metrics:
+    # Stage timings (count, total and max seconds) and event counters, shared by threads.
+    # Disabled by default, see configure_metrics
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.__lock = threading.Lock()
+        self.__stages: Dict[str, List[float]] = dict()  # stage -> [count, total seconds, max seconds]
+        self.__counters: Dict[str, float] = dict()
+
+    def timer(self, stage: str):
+        if not self.enabled:
+            return NULL_TIMER
+        return StageTimer(self, stage)
+
+    def timed(self, function: Callable, stage: str) -> Callable:
+        # for calls in hot loops: the function itself is returned while metrics are disabled
+        if not self.enabled:
+            return function
+
+        def timed_function(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.observe(stage, time.perf_counter() - started)
+        return timed_function
+
+    def observe(self, stage: str, seconds: float):
+        if not self.enabled:
+            return
+        with self.__lock:
+            timing = self.__stages.get(stage)
+            if timing is None:
+                self.__stages[stage] = [1, seconds, seconds]
+                return
+            timing[0] += 1
+            timing[1] += seconds
+            if seconds > timing[2]:
+                timing[2] = seconds
+
+    def count(self, counter: str, amount: float = 1):
+        if not self.enabled:
+            return
+        with self.__lock:
+            self.__counters[counter] = self.__counters.get(counter, 0) + amount
+
+    def reset(self):
+        with self.__lock:
+            self.__stages.clear()
+            self.__counters.clear()
+
+    def snapshot(self) -> dict:
+        with self.__lock:
+            return {
+                "stages": {
+                    stage: {"count": count, "total_seconds": total, "max_seconds": longest}
+                    for stage, (count, total, longest) in self.__stages.items()
+                },
+                "counters": dict(self.__counters),
+            }
+
+    def to_json_line(self) -> str:
+        return json.dumps(dict(timestamp=time.time(), **self.snapshot()), ensure_ascii=False)
+
+    def to_prometheus(self) -> str:
+        # text exposition format, stages and counters are labels of a few metrics
+        snapshot = self.snapshot()
+        lines = [
+            f"# TYPE {METRIC_PREFIX}_stage_seconds summary",
+        ]
+        for stage, timing in sorted(snapshot["stages"].items()):
+            label = f'{{stage="{escape_label(stage)}"}}'
+            lines.append(f"{METRIC_PREFIX}_stage_seconds_count{label} {timing['count']}")
+            lines.append(f"{METRIC_PREFIX}_stage_seconds_sum{label} {timing['total_seconds']:.6f}")
+        lines.append(f"# TYPE {METRIC_PREFIX}_stage_max_seconds gauge")
+        for stage, timing in sorted(snapshot["stages"].items()):
+            lines.append(f'{METRIC_PREFIX}_stage_max_seconds{{stage="{escape_label(stage)}"}} '
+                         f'{timing["max_seconds"]:.6f}')
+        lines.append(f"# TYPE {METRIC_PREFIX}_events_total counter")
+        for counter, value in sorted(snapshot["counters"].items()):
+            lines.append(f'{METRIC_PREFIX}_events_total{{event="{escape_label(counter)}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def configure_metrics(config=None):
+    # config is the [metrics] section, every key is optional:
+    # enabled, json_log (file to append snapshots to), prometheus_file, prometheus_port, publish_interval
+    # (seconds between writes of json_log and prometheus_file, 60 by default) and profile.
+    # Returns the endpoint server if prometheus_port is set
+    config = config or dict()
+    METRICS.enabled = bool(config.get("enabled", False))
+    port = config.get("prometheus_port")
+    if METRICS.enabled and port:
+        return serve_prometheus(port)
+    return None
+
+
+def publish_metrics(config=None):
+    # writes the current snapshot where the config says
+    config = config or dict()
+    if not METRICS.enabled:
+        return
+    if config.get("json_log"):
+        with open(config["json_log"], "a", encoding="utf8") as log_file:
+            log_file.write(METRICS.to_json_line() + "\n")
+    if config.get("prometheus_file"):
+        # scrapers never see a half-written file
+        temporary_path = config["prometheus_file"] + ".tmp"
+        with open(temporary_path, "w", encoding="utf8") as prometheus_file:
+            prometheus_file.write(METRICS.to_prometheus())
+        os.replace(temporary_path, config["prometheus_file"])
+
+
+def publish_metrics_periodically(config=None) -> Callable[[], None]:
+    # Calls publish_metrics every publish_interval seconds from a daemon thread, so long runs
+    # like watch and daemon show up before they end. Returns the function that stops it
+    config = config or dict()
+    if not METRICS.enabled or not (config.get("json_log") or config.get("prometheus_file")):
+        return lambda: None
+    interval = config.get("publish_interval", 60)
+    stopped = threading.Event()
+
+    def publish():
+        while not stopped.wait(interval):
+            publish_metrics(config)
+
+    thread = threading.Thread(target=publish, daemon=True)
+    thread.start()
+
+    def stop():
+        stopped.set()
+        thread.join()
+
+    return stop
+
+
+def serve_prometheus(port: int, host: str = "127.0.0.1"):
+    # /metrics in the text format, served from a daemon thread. Returns the server
+    return serve_body(port, lambda: METRICS.to_prometheus().encode(), "text/plain; version=0.0.4",
+                      path="/metrics", host=host)
+
+
+def serve_body(port: int, get_body: Callable[[], bytes], content_type: str, path: Optional[str] = None,
+               host: str = "127.0.0.1"):
+    # Answers GET requests with get_body() on path (any path if it's None), from a daemon thread.
+    # Returns the server
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if path is not None and self.path.split("?")[0] != path:
+                self.send_error(404)
+                return
+            body = get_body()
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("Cache-Control", "no-store")
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@contextmanager
+def profiling(config=None) -> Iterator[None]:
+    # With a profile path in the config everything inside is run under cProfile and the stats are saved there
+    config = config or dict()
+    profile_path = config.get("profile")
+    if not profile_path:
+        yield
+        return
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(profile_path)
@@ -0,0 +1,189 @@
+import asyncio
+import queue
+import threading
+import time
+from typing import AsyncIterator, Iterator, List, Optional, Tuple
+
+import aiohttp
+
+from tumblr_client import RequestMetrics, TokenBucket, TumblrApiError
+
+NotesPage = List[dict]
+TimeRange = Tuple[Optional[int], Optional[int]]  # (newer_than, before), None means unbounded
+
+
+class AsyncNotesFetcher:
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, api_key: str, host: str = "https://api.tumblr.com", concurrency: int = 4,
+                 ranges_per_worker: int = 4, max_retries: int = 5, backoff: float = 1.0,
+                 rate_limiter: Optional[TokenBucket] = None, metrics: Optional[RequestMetrics] = None,
+                 buffered_pages: int = 2, timeout: float = 30):
+        # rate_limiter and metrics can be shared with TumblrApiClient, so both count against one quota.
+        # Every time range buffers up to buffered_pages pages ahead of the consumer, fetching waits after that.
+        # timeout is in seconds for a whole request, same as in TumblrApiClient
+        self.api_key = api_key
+        self.host = host.rstrip("/")
+        self.concurrency = concurrency
+        self.ranges_per_worker = ranges_per_worker
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.rate_limiter = rate_limiter
+        self.metrics = metrics
+        self.buffered_pages = buffered_pages
+        self.timeout = timeout
+
+    async def iter_pages(self, post: dict, mode: str = "conversation",
+                         newer_than: Optional[int] = None) -> AsyncIterator[NotesPage]:
+        # Pages are yielded newest first, same as following '_links.next' one by one.
+        # With newer_than only notes from that timestamp on are fetched
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            semaphore = asyncio.Semaphore(self.concurrency)
+            time_ranges = self._split_time_range(post, newer_than)
+            range_pages = [asyncio.Queue(maxsize=self.buffered_pages) for _ in time_ranges]
+            tasks = [
+                asyncio.create_task(self._fetch_range(session, semaphore, post, mode, time_range, pages))
+                for time_range, pages in zip(time_ranges, range_pages)
+            ]
+            try:
+                for pages in range_pages:
+                    page = await pages.get()
+                    while page is not None:
+                        if isinstance(page, Exception):
+                            raise page
+                        yield page
+                        page = await pages.get()
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+    def iter_pages_sync(self, post: dict, mode: str = "conversation",
+                        newer_than: Optional[int] = None) -> Iterator[NotesPage]:
+        # Runs the fetch in a background event loop, pages are handed over as soon as they are in order.
+        # The hand-over is bounded as well, so the fetch waits while the consumer is behind
+        pages = queue.Queue(maxsize=self.buffered_pages)
+        stop = threading.Event()
+
+        def hand_over(item) -> bool:
+            # gives up once the consumer has stopped, nobody would take the item
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        async def pump():
+            try:
+                async for page in self.iter_pages(post, mode, newer_than):
+                    # in a thread, the other ranges keep filling their own buffers meanwhile
+                    if not await asyncio.to_thread(hand_over, page):
+                        break
+            except Exception as error:
+                hand_over(error)
+            finally:
+                hand_over(None)
+
+        thread = threading.Thread(target=asyncio.run, args=(pump(),), daemon=True)
+        thread.start()
+        try:
+            page = pages.get()
+            while page is not None:
+                if isinstance(page, Exception):
+                    raise page
+                yield page
+                page = pages.get()
+        finally:
+            stop.set()
+
+    def _split_time_range(self, post: dict, newer_than: Optional[int] = None) -> List[TimeRange]:
+        # Notes are requested in several time ranges at once, newest range first.
+        # Most notes come right after posting, so the ranges get shorter towards the post time
+        ranges_amount = self.concurrency * self.ranges_per_worker
+        if newer_than is not None:
+            start = newer_than
+        elif 'timestamp' in post:
+            start = int(post['timestamp'])
+        else:
+            return [(None, None)]
+        duration = int(time.time()) - start
+        if ranges_amount <= 1 or duration <= 0:
+            return [(newer_than, None)]
+        bounds = sorted({
+            start + int(duration * (index / ranges_amount) ** 2)
+            for index in range(1, ranges_amount)
+        } - {start})
+        edges = [newer_than] + bounds + [None]
+        return [(edges[index], edges[index + 1]) for index in reversed(range(len(edges) - 1))]
+
+    async def _fetch_range(self, session: aiohttp.ClientSession, semaphore: asyncio.Semaphore, post: dict,
+                           mode: str, time_range: TimeRange, pages: asyncio.Queue):
+        newer_than, before = time_range
+        path = f"/v2/blog/{post['blog_name']}/notes"
+        params = {"id": post['id_string'], "mode": mode}
+        if before is not None:
+            params["before_timestamp"] = before
+        try:
+            while True:
+                async with semaphore:
+                    response = await self._get(session, path, params)
+                notes = [
+                    note for note in response['notes']
+                    if (before is None or note['timestamp'] < before)
+                    and (newer_than is None or note['timestamp'] >= newer_than)
+                ]
+                if notes:
+                    await pages.put(notes)
+                # stop as soon as the older range is reached
+                if len(notes) < len(response['notes']) or '_links' not in response:
+                    break
+                assert 'next' in response['_links']
+                params = {"id": post['id_string'], "mode": mode, **response['_links']['next']['query_params']}
+        except Exception as error:
+            await pages.put(error)
+        await pages.put(None)
+
+    async def _get(self, session: aiohttp.ClientSession, path: str, params: dict) -> dict:
+        params = {key: str(value) for key, value in params.items()}
+        params["api_key"] = self.api_key
+        attempt = 0
+        while True:
+            if self.rate_limiter:
+                await asyncio.sleep(self.rate_limiter.reserve())
+            started = time.perf_counter()
+            try:
+                async with session.get(self.host + path, params=params) as response:
+                    if self.metrics:
+                        self.metrics.record_request("notes", response.status, time.perf_counter() - started)
+                    if response.status not in self.RETRY_STATUSES or attempt >= self.max_retries:
+                        return await self._parse_response(response)
+                    delay = self._get_retry_delay(response, attempt)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if attempt >= self.max_retries:
+                    raise
+                delay = self._get_retry_delay(None, attempt)
+            if self.metrics:
+                self.metrics.record_retry()
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def _get_retry_delay(self, response: Optional[aiohttp.ClientResponse], attempt: int) -> float:
+        try:
+            return float(response.headers["Retry-After"])
+        except (AttributeError, KeyError, ValueError):
+            return self.backoff * 2 ** attempt
+
+    @staticmethod
+    async def _parse_response(response: aiohttp.ClientResponse) -> dict:
+        # same errors as TumblrApiClient
+        try:
+            data = await response.json(content_type=None)
+        except ValueError:
+            raise TumblrApiError(response.status, "Malformed JSON or HTML was returned")
+        if not 200 <= response.status <= 399:
+            raise TumblrApiError(response.status, data.get('meta', dict()).get('msg', response.reason))
+        return data['response']
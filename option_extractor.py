@@ -0,0 +1,112 @@
+import re
+from html import unescape
+from typing import Iterable, List, Optional, Sequence, Tuple, TypeVar
+
+# a tag, a comment or the text up to the next tag, a '<' that can't start a tag is text as well
+TOKEN_REGEX = re.compile(r"<(/?)([a-zA-Z][a-zA-Z0-9]*)\b[^>]*>|<!--.*?-->|((?:[^<]+|<(?![a-zA-Z/!]))+|<)", re.S)
+LINE_OPTION_REGEX = re.compile(r"\d+\) ")
+LIST_TAGS = frozenset(("ol", "ul"))
+NPF_LIST_TAGS = {"ordered-list-item": "ol", "unordered-list-item": "ul"}
+NPF_LIST_SUBTYPES = frozenset(NPF_LIST_TAGS)
+# between an item and the items of a list nested in it
+NESTED_ITEM_SEPARATOR = "\n"
+T = TypeVar("T")
+
+
+def extract_caption_options(caption: str) -> List[str]:
+    # Items of the first <ol> with at least two of them, of the first such <ul> if there's no <ol>,
+    # "N) text" lines if there's no such list at all.
+    # Markup inside an item is flattened into its text, items of nested lists go on lines of their own
+    lists: List[Tuple[str, List[List[str]]]] = list()
+    line_options: List[str] = list()
+    current_list: Optional[List[List[str]]] = None
+    list_depth = 0
+    inside_item = False
+    for closing, tag, text in TOKEN_REGEX.findall(caption):
+        if tag:
+            tag = tag.lower()
+            if tag in LIST_TAGS:
+                if not closing:
+                    list_depth += 1
+                    if list_depth == 1:
+                        current_list = list()
+                        lists.append((tag, current_list))
+                elif list_depth:
+                    list_depth -= 1
+                    if list_depth == 0:
+                        current_list = None
+                        inside_item = False
+            elif tag == "li" and list_depth == 1:
+                inside_item = not closing
+                if inside_item:
+                    current_list.append(list())
+            elif tag == "li" and inside_item and not closing and current_list[-1]:
+                current_list[-1].append(NESTED_ITEM_SEPARATOR)
+        elif text:
+            text = unescape(text)
+            if inside_item:
+                current_list[-1].append(text)
+            elif list_depth == 0:
+                line_options.extend(get_line_options(text.splitlines()))
+
+    option_list = get_options_list(lists)
+    if option_list is not None:
+        return ["".join(item_parts) for item_parts in option_list]
+    return line_options
+
+
+def extract_npf_options(content: Iterable[dict]) -> List[str]:
+    # Same rules for NPF content blocks: the first run of at least two ordered list items,
+    # of unordered ones if there's no such run, "N) text" lines otherwise
+    lists: List[Tuple[str, List[str]]] = list()
+    line_options: List[str] = list()
+    current_list: Optional[List[str]] = None
+    current_subtype: Optional[str] = None
+    for block in content:
+        if block.get("type") != "text":
+            current_list = None
+            continue
+        subtype = block.get("subtype")
+        if subtype in NPF_LIST_SUBTYPES:
+            # nested items belong to the item above them
+            if block.get("indent_level", 0) and current_list:
+                current_list[-1] += NESTED_ITEM_SEPARATOR + block["text"]
+                continue
+            if current_list is None or subtype != current_subtype:
+                current_list = list()
+                current_subtype = subtype
+                lists.append((NPF_LIST_TAGS[subtype], current_list))
+            current_list.append(block["text"])
+        else:
+            current_list = None
+            line_options.extend(get_line_options(block.get("text", "").splitlines()))
+
+    option_list = get_options_list(lists)
+    if option_list is not None:
+        return option_list
+    return line_options
+
+
+def get_options_list(lists: Sequence[Tuple[str, T]]) -> Optional[T]:
+    # (list tag, items) in the order of the post, ordered lists go first
+    for preferred_tag in ("ol", "ul"):
+        for tag, items in lists:
+            if tag == preferred_tag and len(items) >= 2:
+                return items
+    return None
+
+
+def extract_post_options(post: dict) -> List[str]:
+    # legacy posts have an HTML caption, NPF ones (npf=true) have content blocks
+    if post.get("caption"):
+        return extract_caption_options(post["caption"])
+    if post.get("content"):
+        return extract_npf_options(post["content"])
+    return list()
+
+
+def get_line_options(lines: Iterable[str]) -> Iterable[str]:
+    for line in lines:
+        match = LINE_OPTION_REGEX.match(line)
+        if match:
+            yield line[match.end():]
@@ -0,0 +1,104 @@
+import hashlib
+import json
+import os
+from dataclasses import dataclass, asdict
+from typing import Dict, List, Optional, Tuple
+
+from image_text_extractor import FileInfo, PageSummary, list_pages, map_in_pool, summarize_page
+
+
+@dataclass
+class PageIndexEntry:
+    size: int
+    mtime_ns: int
+    content_hash: str
+    summary: PageSummary
+
+
+def _hash_page(page_data: bytes) -> str:
+    return hashlib.blake2b(page_data, digest_size=20).hexdigest()
+
+
+def _index_page(task: Tuple[str, Optional[PageIndexEntry]]) -> PageIndexEntry:
+    page_path, known_entry = task
+    with open(page_path, "rb") as page_file:
+        stat = os.fstat(page_file.fileno())
+        page_data = page_file.read()
+    content_hash = _hash_page(page_data)
+    if known_entry and known_entry.content_hash == content_hash:
+        # only touched, the old summary is still valid
+        summary = known_entry.summary
+    else:
+        summary = summarize_page(page_path, page_data=page_data)
+    return PageIndexEntry(size=stat.st_size, mtime_ns=stat.st_mtime_ns, content_hash=content_hash, summary=summary)
+
+
+class PageIndex:
+    VERSION = 1
+
+    def __init__(self, index_path: str = "data/page_index.json"):
+        self.index_path = index_path
+        self.entries: Dict[str, PageIndexEntry] = dict()
+        try:
+            self.__load()
+        except FileNotFoundError:
+            pass
+
+    def __load(self):
+        with open(self.index_path, "r", encoding="utf8") as index_file:
+            index = json.load(index_file)
+        if index.get("version") != self.VERSION:
+            return
+        for page_path, entry in index["pages"].items():
+            summary = entry["summary"]
+            if summary["file_info"]:
+                summary["file_info"] = FileInfo(**summary["file_info"])
+            summary["app_extensions"] = [tuple(extension) for extension in summary["app_extensions"]]
+            entry["summary"] = PageSummary(**summary)
+            # indexes saved before the paths were normalized could have the same page under several keys
+            self.entries[os.path.normpath(page_path)] = PageIndexEntry(**entry)
+
+    def save(self):
+        index = {
+            "version": self.VERSION,
+            "pages": {page_path: asdict(entry) for page_path, entry in self.entries.items()},
+        }
+        index_dir = os.path.dirname(self.index_path)
+        if index_dir:
+            os.makedirs(index_dir, exist_ok=True)
+        temp_path = f"{self.index_path}.tmp"
+        with open(temp_path, "w", encoding="utf8") as index_file:
+            json.dump(fp=index_file, obj=index, ensure_ascii=False)
+        os.replace(temp_path, self.index_path)
+
+    def is_up_to_date(self, page_path: str, stat: os.stat_result) -> bool:
+        entry = self.entries.get(page_path)
+        return entry is not None and entry.size == stat.st_size and entry.mtime_ns == stat.st_mtime_ns
+
+    def rescan(self, pages_dir: str = "pages", workers: Optional[int] = None, chunk_size: int = 8) -> List[str]:
+        # Only stats the pages, new and changed ones are read and parsed again. Returns the re-read pages.
+        # Pages are keyed by normalized paths, so "pages", "pages/" and "./pages" share the entries
+        pages_dir = os.path.normpath(pages_dir)
+        page_paths = [os.path.normpath(page_path) for page_path in list_pages(pages_dir)]
+        stale_pages = [
+            page_path for page_path in page_paths
+            if not self.is_up_to_date(page_path, os.stat(page_path))
+        ]
+        existing_pages = set(page_paths)
+        removed_pages = [
+            page_path for page_path in self.entries
+            if os.path.dirname(page_path) == pages_dir and page_path not in existing_pages
+        ]
+        for page_path in removed_pages:
+            del self.entries[page_path]
+
+        tasks = [(page_path, self.entries.get(page_path)) for page_path in stale_pages]
+        for page_path, entry in zip(stale_pages, map_in_pool(_index_page, tasks, workers, chunk_size)):
+            self.entries[page_path] = entry
+
+        if stale_pages or removed_pages:
+            self.save()
+        return stale_pages
+
+    def summaries(self) -> List[PageSummary]:
+        return [self.entries[page_path].summary for page_path in sorted(self.entries)]
@@ -0,0 +1,274 @@
+import argparse
+import os
+import re
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from image_text_extractor import PageFileParser, map_in_pool
+from metrics import METRICS
+from page_index import PageIndex
+
+# Frame timing and layout of the whole archive as columns, one row per frame of every page.
+# Frames are read once per page content and cached next to the page index, everything else is numpy
+
+# raw fields of a frame as they are in the file, the graphic control extension is decoded for all frames at once
+RAW_FRAME_DTYPE = np.dtype([
+    ("left", "<u2"),
+    ("top", "<u2"),
+    ("width", "<u2"),
+    ("height", "<u2"),
+    ("local_color_table", "?"),
+    ("color_table_size", "<u2"),
+    ("interlace", "?"),
+    ("has_graphic_control", "?"),
+    ("graphic_control", "u1", (4,)),  # packed flags, delay (2 bytes, hundredths of a second), transparent index
+])
+FRAME_DTYPE = np.dtype([
+    ("page", "<i4"),  # row in pages
+    ("left", "<u2"),
+    ("top", "<u2"),
+    ("width", "<u2"),
+    ("height", "<u2"),
+    ("local_color_table", "?"),
+    ("colors", "<u2"),  # size of the color table the frame uses, local or global
+    ("interlace", "?"),
+    ("delay", "<u2"),  # hundredths of a second
+    ("disposal", "u1"),
+    ("transparent", "?"),
+])
+PAGE_DTYPE = np.dtype([
+    ("act", "<i2"),  # index in acts
+    ("width", "<u2"),
+    ("height", "<u2"),
+    ("global_colors", "<u2"),  # 0 without a global color table
+    ("frame_start", "<i8"),  # first row in frames
+    ("frame_count", "<i4"),
+    ("parsed", "?"),
+])
+PAGE_STATS_DTYPE = np.dtype([
+    ("frame_count", "<i4"),
+    ("duration", "<f8"),  # seconds
+    ("coverage", "<f8"),  # mean share of the canvas a frame redraws
+    ("local_color_tables", "<i4"),  # frames with their own color table
+    ("mean_colors", "<f8"),  # mean color table size of the frames
+])
+ACT_STATS_DTYPE = np.dtype([
+    ("pages", "<i4"),
+    ("frame_count", "<i8"),
+    ("duration", "<f8"),
+    ("coverage", "<f8"),
+    ("local_color_tables", "<i8"),
+    ("mean_colors", "<f8"),
+])
+
+# AF_01_0002A.gif, AF_01_0021_B.gif and AF_HIATUS_001.gif are pages of the acts "01", "01" and "HIATUS"
+PAGE_NAME_REGEX = re.compile(r"^(?:AF_)?(.+?)_\d+(?:_?[A-Za-z])?\.gif$", re.IGNORECASE)
+CACHE_VERSION = 1
+
+
+def get_act(page_path: str) -> str:
+    # pages named some other way are an act of their own folder
+    match = PAGE_NAME_REGEX.match(os.path.basename(page_path))
+    if match:
+        return match.group(1)
+    return os.path.basename(os.path.dirname(page_path))
+
+
+def get_cache_path(index_path: str) -> str:
+    return os.path.splitext(index_path)[0] + "_frames.npz"
+
+
+def read_page_frames(page_path: str) -> Optional[np.ndarray]:
+    # Raw frames of a page, None if it can't be parsed
+    try:
+        with METRICS.timer("page_stats.read_frames"):
+            return np.array([
+                (
+                    descriptor.image_left, descriptor.image_top, descriptor.image_width, descriptor.image_height,
+                    descriptor.local_color_table_flag, descriptor.color_table_size, descriptor.interlace_flag,
+                    descriptor.graphic_control is not None,
+                    tuple(descriptor.graphic_control.data[:4].ljust(4, b"\x00"))
+                    if descriptor.graphic_control else (0, 0, 0, 0),
+                )
+                for descriptor in PageFileParser(page_path, lazy=True).iter_image_descriptors()
+            ], dtype=RAW_FRAME_DTYPE)
+    except Exception:
+        return None
+
+
+def decode_frames(raw_frames: np.ndarray, pages: np.ndarray) -> np.ndarray:
+    # frame_start and frame_count of pages should point into raw_frames
+    frames = np.zeros(len(raw_frames), dtype=FRAME_DTYPE)
+    frames["page"] = np.repeat(np.arange(len(pages), dtype=np.int32), pages["frame_count"])
+    for name in ("left", "top", "width", "height", "local_color_table", "interlace"):
+        frames[name] = raw_frames[name]
+    frames["colors"] = np.where(raw_frames["local_color_table"], raw_frames["color_table_size"],
+                                pages["global_colors"][frames["page"]])
+    graphic_control = raw_frames["graphic_control"]
+    frames["delay"] = graphic_control[:, 1] | (graphic_control[:, 2].astype(np.uint16) << 8)
+    frames["disposal"] = (graphic_control[:, 0] >> 2) & 0x07
+    frames["transparent"] = (graphic_control[:, 0] & 0x01).astype(bool) & raw_frames["has_graphic_control"]
+    return frames
+
+
+class PageFrameStats:
+    def __init__(self, page_paths: List[str], content_hashes: List[str], acts: List[str],
+                 pages: np.ndarray, raw_frames: np.ndarray):
+        self.page_paths = page_paths
+        self.content_hashes = content_hashes
+        self.acts = acts
+        self.pages = pages
+        self.raw_frames = raw_frames
+        self.frames = decode_frames(raw_frames, pages)
+
+    @classmethod
+    def from_index(cls, index: PageIndex, workers: Optional[int] = None, chunk_size: int = 8,
+                   cache_path: Optional[str] = None) -> "PageFrameStats":
+        # Pages of the index, it should be rescanned before. Frames of a page with the same content
+        # are taken from the cache, only new and changed pages are read
+        cache_path = cache_path or get_cache_path(index.index_path)
+        cached_frames = cls.__load_cached_frames(cache_path)
+        page_paths = sorted(index.entries)
+        content_hashes = [index.entries[page_path].content_hash for page_path in page_paths]
+
+        stale_pages = [
+            page_path for page_path, content_hash in zip(page_paths, content_hashes)
+            if content_hash not in cached_frames and index.entries[page_path].summary.error is None
+        ]
+        with METRICS.timer("page_stats.build"):
+            read_frames = dict(zip(stale_pages, map_in_pool(read_page_frames, stale_pages, workers, chunk_size)))
+            page_acts = [get_act(page_path) for page_path in page_paths]
+            acts = sorted(set(page_acts))
+            act_indices = {act: act_index for act_index, act in enumerate(acts)}
+            pages = np.zeros(len(page_paths), dtype=PAGE_DTYPE)
+            pages["act"] = [act_indices[act] for act in page_acts]
+            page_frames = [
+                read_frames[page_path] if page_path in read_frames else cached_frames.get(content_hash)
+                for page_path, content_hash in zip(page_paths, content_hashes)
+            ]
+            file_infos = [index.entries[page_path].summary.file_info for page_path in page_paths]
+            parsed = [file_info is not None and frames is not None
+                      for file_info, frames in zip(file_infos, page_frames)]
+            pages["parsed"] = parsed
+            pages["width"][parsed] = [file_info.image_width for file_info, ok in zip(file_infos, parsed) if ok]
+            pages["height"][parsed] = [file_info.image_height for file_info, ok in zip(file_infos, parsed) if ok]
+            pages["global_colors"][parsed] = [
+                file_info.global_color_table_size if file_info.global_color_table_flag else 0
+                for file_info, ok in zip(file_infos, parsed) if ok
+            ]
+            pages["frame_count"][parsed] = [len(frames) for frames, ok in zip(page_frames, parsed) if ok]
+            frame_ends = np.cumsum(pages["frame_count"])
+            pages["frame_start"][1:] = frame_ends[:-1]
+            # filled in place, concatenating thousands of structured arrays is slow
+            raw_frames = np.zeros(frame_ends[-1] if len(pages) else 0, dtype=RAW_FRAME_DTYPE)
+            for frames, frame_start, ok in zip(page_frames, pages["frame_start"], parsed):
+                if ok:
+                    raw_frames[frame_start:frame_start + len(frames)] = frames
+        stats = cls(page_paths, content_hashes, acts, pages, raw_frames)
+        parsed_hashes = {content_hash for content_hash, parsed in zip(content_hashes, pages["parsed"]) if parsed}
+        if parsed_hashes != set(cached_frames):
+            stats.save(cache_path)
+        return stats
+
+    def save(self, cache_path: str):
+        # only the pages that were read, the rest is in the index
+        parsed = self.pages["parsed"]
+        temp_path = f"{cache_path}.tmp.npz"
+        np.savez(
+            temp_path,
+            version=np.array(CACHE_VERSION),
+            content_hashes=np.array(self.content_hashes, dtype=str)[parsed],
+            frame_counts=self.pages["frame_count"][parsed],
+            raw_frames=self.raw_frames,
+        )
+        os.replace(temp_path, cache_path)
+
+    @staticmethod
+    def __load_cached_frames(cache_path: str) -> Dict[str, np.ndarray]:
+        # content hash -> raw frames of the page
+        try:
+            with np.load(cache_path, allow_pickle=False) as cache:
+                if cache["version"] != CACHE_VERSION:
+                    return dict()
+                content_hashes = cache["content_hashes"]
+                frame_starts = np.concatenate(([0], np.cumsum(cache["frame_counts"])))
+                raw_frames = cache["raw_frames"]
+        except (FileNotFoundError, KeyError, ValueError):
+            return dict()
+        return {
+            str(content_hash): raw_frames[frame_starts[row]:frame_starts[row + 1]]
+            for row, content_hash in enumerate(content_hashes)
+        }
+
+    def page_stats(self) -> np.ndarray:
+        # one row per page, in the order of page_paths
+        with METRICS.timer("page_stats.pages"):
+            return self.__group_stats(self.frames["page"], len(self.pages), PAGE_STATS_DTYPE)
+
+    def act_stats(self) -> Tuple[List[str], np.ndarray]:
+        # one row per act, in the order of acts
+        with METRICS.timer("page_stats.acts"):
+            frame_acts = self.pages["act"][self.frames["page"]]
+            stats = self.__group_stats(frame_acts, len(self.acts), ACT_STATS_DTYPE)
+            stats["pages"] = np.bincount(self.pages["act"], minlength=len(self.acts))
+            return self.acts, stats
+
+    def __group_stats(self, groups: np.ndarray, groups_count: int, dtype: np.dtype) -> np.ndarray:
+        # totals of the frames of every group, means are per frame
+        frames = self.frames
+        canvas = self.pages["width"].astype(np.float64) * self.pages["height"]
+        frame_canvas = canvas[frames["page"]]
+        frame_area = frames["width"].astype(np.float64) * frames["height"]
+        coverage = np.divide(frame_area, frame_canvas, out=np.zeros_like(frame_area), where=frame_canvas > 0)
+
+        stats = np.zeros(groups_count, dtype=dtype)
+        frame_counts = np.bincount(groups, minlength=groups_count)
+        stats["frame_count"] = frame_counts
+        stats["duration"] = np.bincount(groups, weights=frames["delay"], minlength=groups_count) / 100
+        stats["local_color_tables"] = np.bincount(groups, weights=frames["local_color_table"],
+                                                  minlength=groups_count)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            stats["coverage"] = np.bincount(groups, weights=coverage, minlength=groups_count) / frame_counts
+            stats["mean_colors"] = np.bincount(groups, weights=frames["colors"], minlength=groups_count) / frame_counts
+        return stats
+
+
+def format_act_stats(acts: List[str], stats: np.ndarray) -> str:
+    lines = [f"{'act':<10} {'pages':>6} {'frames':>8} {'duration':>10} {'coverage':>9} {'local CT':>9} {'colors':>7}"]
+    for act, act_stats in zip(acts, stats):
+        lines.append(
+            f"{act:<10} {act_stats['pages']:>6} {act_stats['frame_count']:>8} {act_stats['duration']:>9.1f}s "
+            f"{act_stats['coverage']:>9.1%} {act_stats['local_color_tables']:>9} {act_stats['mean_colors']:>7.1f}"
+        )
+    return "\n".join(lines)
+
+
+def _parse_arguments():
+    parser = argparse.ArgumentParser(description="Frame timing and layout statistics of the page archive")
+    parser.add_argument("pages_dir", nargs="?", default="pages")
+    parser.add_argument("--index", default="data/page_index.json",
+                        help="page index file, frames are cached next to it")
+    parser.add_argument("-j", "--workers", type=int, default=None,
+                        help="amount of parser processes, all cores by default")
+    parser.add_argument("--chunk-size", type=int, default=8,
+                        help="amount of pages sent to a process at once")
+    parser.add_argument("--pages", action="store_true", help="print the statistics of every page as well")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    ARGUMENTS = _parse_arguments()
+    INDEX = PageIndex(ARGUMENTS.index)
+    INDEX.rescan(ARGUMENTS.pages_dir, ARGUMENTS.workers, ARGUMENTS.chunk_size)
+    STATS = PageFrameStats.from_index(INDEX, ARGUMENTS.workers, ARGUMENTS.chunk_size)
+    if ARGUMENTS.pages:
+        for PAGE_PATH, PAGE_STATS, PAGE in zip(STATS.page_paths, STATS.page_stats(), STATS.pages):
+            if not PAGE["parsed"]:
+                print(f"{os.path.basename(PAGE_PATH)}: --- ERROR ---")
+                continue
+            print(f"{os.path.basename(PAGE_PATH)}: {PAGE_STATS['frame_count']} frames, "
+                  f"{PAGE_STATS['duration']:.2f}s, {PAGE_STATS['coverage']:.1%} coverage")
+        print("")
+    print(format_act_stats(*STATS.act_stats()))
+    print(f"\n{STATS.pages['parsed'].sum()} of {len(STATS.pages)} pages parsed")
@@ -1,62 +1,61 @@
 import json
 import re
-from html.parser import HTMLParser
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from itertools import islice
+from typing import Optional, Callable, Iterator, Iterable, List, Dict, Set, Tuple, TYPE_CHECKING
+
+from alias_matcher import FuzzyAliasMatcher
+from metrics import METRICS
+from option_extractor import extract_post_options
+from tumblr_client import TumblrApiClient
+from utils import format_reply, PostVotes
+from votes_export import iter_vote_rows
 
-from pytumblr import TumblrRestClient
+if TYPE_CHECKING:
+    # SQLAlchemy and aiohttp are slow to import, they are imported only when the config needs them
+    from database.helper import NotesStore, VotesDatabase
+    from notes_fetcher import AsyncNotesFetcher
 
-from utils import format_reply, PostVotes
+EXTRACT_TEXT_REGEX = re.compile(r"\W*")
+NoteKey = Tuple[int, str, str, Optional[str]]  # (timestamp, blog_name, type, reply_text), same as the notes store key
 
 
-class PostCaptionParser(HTMLParser):
-    def __init__(self):
-        super().__init__()
-        self.options = list()
-        self.current_option = 0
-        self.handled_list = False
-        self.inside_list_option = False
-        self.option_regex = re.compile(r"\d\) ")
-
-    def handle_starttag(self, tag, attrs):
-        if tag == 'ol':
-            assert not self.handled_list
-            self.handled_list = True
-        elif tag == 'li':
-            self.inside_list_option = True
-
-    def handle_endtag(self, tag):
-        if tag == 'li':
-            self.inside_list_option = False
-            self.current_option += 1
-
-    def handle_data(self, data):
-        if self.inside_list_option:
-            try:
-                self.options[self.current_option] += data
-            except IndexError:
-                self.options.append(data)
-        elif self.option_regex.match(data):
-            self.options.append(data[3:])
+def get_compare_text(text: str) -> str:
+    return EXTRACT_TEXT_REGEX.sub("", text).casefold()
+
+
+def is_poll_post(post: dict) -> bool:
+    # a poll has at least two options
+    return len(extract_post_options(post)) >= 2
+
+
+def get_note_key(note: dict) -> NoteKey:
+    return note['timestamp'], note['blog_name'], note['type'], note.get('reply_text')
 
 
 class PostOptions:
 
-    def __init__(self, post) -> None:
+    def __init__(self, post, fuzzy_threshold: Optional[float] = None,
+                 database: Optional["VotesDatabase"] = None) -> None:
+        # Options are kept in the database if it's passed, in data/<post_id>.json otherwise.
+        # With fuzzy_threshold, replies close enough to a single option's alias are matched as well
         self.__post_id = post['id']
-        self.__extract_text_regex = re.compile(r"\W*")
+        self.__database = database
+        self.__is_stored = False
+        self.__unsaved_aliases: List[Tuple[str, str, str]] = list()
         try:
             self.__load_saved_options()
         except FileNotFoundError:
-            post_html = post['caption']
-            parser = PostCaptionParser()
-            parser.feed(post_html)
-            assert(len(parser.options) >= 2)
+            option_texts = extract_post_options(post)
+            assert(len(option_texts) >= 2)
 
             self.__options = dict()
             self.__options["0"] = list()
 
-            for index, option_text in enumerate(parser.options):
+            for index, option_text in enumerate(option_texts):
                 option_number = str(index + 1)
-                clean_option = self.__extract_text_regex.sub("", option_text).casefold()
+                clean_option = get_compare_text(option_text)
                 self.__options[option_number] = [
                     (option_number, option_number),
                     (option_text, clean_option),
@@ -65,13 +64,40 @@ class PostOptions:
 
             self.__save_current_options()
 
+        # compare text -> option, the first option with the text wins as it did with the full scan
+        self.__alias_index: Dict[str, str] = dict()
+        for option_number, option_variants in self.__options.items():
+            for variant in option_variants:
+                self.__alias_index.setdefault(variant[1], option_number)
+
+        self.__fuzzy_matcher: Optional[FuzzyAliasMatcher] = None
+        if fuzzy_threshold:
+            self.__fuzzy_matcher = FuzzyAliasMatcher(self.__alias_index.items(), threshold=fuzzy_threshold)
+
     def __load_saved_options(self):
+        if self.__database:
+            stored = self.__database.load_post_options(self.__post_id)
+            if stored is None:
+                raise FileNotFoundError(f"No options for post {self.__post_id} in the database")
+            # the stored options are shared through the cache
+            self.__options = {number: list(variants) for number, variants in stored.options.items()}
+            self.__is_stored = True
+            return
         with open(f"data/{self.__post_id}.json", "r", encoding="utf8") as options_file:
             self.__options = json.load(options_file)
 
     def __save_current_options(self):
         # Default "0" and at least two choices
         assert len(self.__options) >= 3
+        if self.__database:
+            # only new aliases are written once the post is stored
+            if self.__is_stored:
+                self.__database.add_post_aliases(self.__post_id, self.__unsaved_aliases)
+            else:
+                self.__database.create_post_options(self.__post_id, self.__options)
+                self.__is_stored = True
+            self.__unsaved_aliases = list()
+            return
         with open(f"data/{self.__post_id}.json", "w", encoding="utf8") as options_file:
             json.dump(fp=options_file, obj=self.__options, indent="\t", ensure_ascii=False)
 
@@ -87,37 +113,111 @@ class PostOptions:
     def options(self):
         return self.__options.keys()
 
-    def get_option_for_reply(self, reply):
-        clean_reply = self.__extract_text_regex.sub("", reply).casefold()
-        for number, option_variants in self.__options.items():
-            for variant in option_variants:
-                if clean_reply == variant[1]:
-                    return number
-        else:
-            reply_option = None
-            while not reply_option:
+    def match_reply(self, reply) -> Optional[str]:
+        clean_reply = get_compare_text(reply)
+        reply_option = self.__alias_index.get(clean_reply)
+        if reply_option is None and self.__fuzzy_matcher:
+            reply_option = self.__fuzzy_matcher.match(clean_reply)
+            if reply_option:
+                METRICS.count("fuzzy_matches")
+        return reply_option
+
+    def add_alias(self, option_number: str, alias_text: str):
+        clean_alias = get_compare_text(alias_text)
+        self.__options[option_number].append((alias_text, clean_alias))
+        self.__unsaved_aliases.append((option_number, alias_text, clean_alias))
+        self.__alias_index.setdefault(clean_alias, option_number)
+        if self.__fuzzy_matcher:
+            self.__fuzzy_matcher.add_alias(clean_alias, self.__alias_index[clean_alias])
+
+    def save(self):
+        self.__save_current_options()
+
+    def ask_option_for_reply(self, reply) -> str:
+        # only asks, the answer isn't added as an alias
+        reply_option = None
+        while not reply_option:
+            METRICS.count("operator_prompts")
+            with METRICS.timer("operator_prompt"):
                 reply_option = input(f"What's the option for '{format_reply(reply)}'?")
-                if reply_option in self.__options:
-                    self.__options[reply_option].append((reply, clean_reply))
-                    self.__save_current_options()
-                    return reply_option
-                else:
-                    print(f"Option {reply_option} is not in options")
-                    reply_option = None
+            if reply_option not in self.__options:
+                print(f"Option {reply_option} is not in options")
+                reply_option = None
+        return reply_option
+
+    def get_option_for_reply(self, reply):
+        reply_option = self.match_reply(reply)
+        if reply_option:
+            return reply_option
+
+        reply_option = self.ask_option_for_reply(reply)
+        self.add_alias(reply_option, reply)
+        self.__save_current_options()
+        return reply_option
 
 
 class PostNotes:
+    STORED_PAGE_SIZE = 1000
 
-    def __init__(self, tumblr_client: TumblrRestClient, post: dict, mode: str = "conversation") -> None:
+    def __init__(self, tumblr_client: TumblrApiClient, post: dict, mode: str = "conversation",
+                 notes_fetcher: Optional["AsyncNotesFetcher"] = None, notes_store: Optional["NotesStore"] = None,
+                 on_page: Optional[Callable[[], None]] = None) -> None:
         self.client = tumblr_client
         self.notes_request_mode = mode
         self.post = post
+        self.notes_fetcher = notes_fetcher
+        self.notes_store = notes_store
+        # called once everything downstream is done with the notes of a page
+        self.on_page = on_page
+
+        self.notes_count = 0
+        self.fetched_notes_count = 0
+        # the newest handled notes, iter_new_notes starts from them
+        self.newest_timestamp: Optional[int] = None
+        self.newest_note_keys: Set[NoteKey] = set()
+
+    def iter_note_pages(self) -> Iterator[List[dict]]:
+        if not self.notes_store:
+            yield from self.__fetch_note_pages()
+            return
+
+        # Notes from the synced timestamp on are fetched, every page is saved in its own short transaction
+        # as it comes: a write lock held across network round-trips blocks every other writer.
+        # The older notes are read from the store after that. The synced timestamp moves only once the fetch
+        # is complete, an interrupted one is started over from the same place
+        post_id = self.post['id']
+        synced_timestamp = self.notes_store.get_synced_timestamp(post_id)
+        newest_timestamp = synced_timestamp
+        for notes_page in self.__fetch_note_pages(newer_than=synced_timestamp):
+            if notes_page:
+                with self.notes_store.database.create_session() as session:
+                    self.notes_store.add_notes(session, post_id, notes_page)
+                    session.commit()
+                newest_timestamp = max(newest_timestamp or 0, max(note['timestamp'] for note in notes_page))
+            yield notes_page
+        if newest_timestamp is not None:
+            with self.notes_store.database.create_session() as session:
+                self.notes_store.set_synced_timestamp(session, post_id, newest_timestamp)
+                session.commit()
+        if synced_timestamp is None:
+            # everything was fetched
+            return
+
+        # notes of the synced timestamp itself were fetched again
+        stored_notes = self.notes_store.iter_notes(post_id, older_than=synced_timestamp)
+        notes_page = list(islice(stored_notes, self.STORED_PAGE_SIZE))
+        while notes_page:
+            yield notes_page
+            notes_page = list(islice(stored_notes, self.STORED_PAGE_SIZE))
+
+    def __fetch_note_pages(self, newer_than: Optional[int] = None) -> Iterator[List[dict]]:
+        # every note from the API is counted in fetched_notes_count, with the store or without it
+        if self.notes_fetcher:
+            for notes_page in self.notes_fetcher.iter_pages_sync(self.post, self.notes_request_mode, newer_than):
+                self.fetched_notes_count += len(notes_page)
+                yield notes_page
+            return
 
-        self.cached_notes = list()
-        self.__cache_post_notes()
-        assert len(self.cached_notes) > 0
-
-    def __cache_post_notes(self):
         post_blog = self.post['blog_name']
         post_id = self.post['id_string']
         notes = self.client.notes(
@@ -125,100 +225,412 @@ class PostNotes:
             id=post_id,
             mode=self.notes_request_mode,
         )
-        for note in notes['notes']:
-            self.cached_notes.append(note)
-
-        while '_links' in notes:
+        while True:
+            new_notes = [
+                note for note in notes['notes']
+                if newer_than is None or note['timestamp'] >= newer_than
+            ]
+            self.fetched_notes_count += len(new_notes)
+            yield new_notes
+            # the rest are known already
+            if len(new_notes) < len(notes['notes']) or '_links' not in notes:
+                break
             assert 'next' in notes['_links']
             next_link = notes['_links']['next']
             notes = self.client.notes(
                 blogname=post_blog,
                 **next_link['query_params']
             )
-            for note in notes['notes']:
-                self.cached_notes.append(note)
+
+    def iter_notes(self) -> Iterator[dict]:
+        # Notes are streamed page by page, nothing is kept after a page is handled.
+        # Handling time of a page is everything done with its notes downstream
+        note_pages = self.iter_note_pages()
+        while True:
+            with METRICS.timer("notes_page_fetch"):
+                notes_page = next(note_pages, None)
+            if notes_page is None:
+                break
+            with METRICS.timer("notes_page_handling"):
+                for note in notes_page:
+                    self.notes_count += 1
+                    self.__track_newest(note)
+                    yield note
+            if self.on_page:
+                self.on_page()
+
+    def iter_new_notes(self) -> Iterator[dict]:
+        # Notes posted after everything handled so far, newest first. They are saved to the store as well.
+        # The newest timestamp is fetched again, notes of it that were handled already are skipped
+        known_note_keys = self.newest_note_keys
+        new_notes = list()
+        with METRICS.timer("notes_page_fetch"):
+            for notes_page in self.__fetch_note_pages(newer_than=self.newest_timestamp):
+                new_notes.extend(note for note in notes_page if get_note_key(note) not in known_note_keys)
+        if self.notes_store and new_notes:
+            # the fetch is complete, the synced timestamp moves with the notes
+            with self.notes_store.database.create_session() as session:
+                self.notes_store.add_notes(session, self.post['id'], new_notes)
+                self.notes_store.set_synced_timestamp(
+                    session, self.post['id'], max(note['timestamp'] for note in new_notes)
+                )
+                session.commit()
+        for note in new_notes:
+            self.notes_count += 1
+            self.__track_newest(note)
+            yield note
+
+    def __track_newest(self, note: dict):
+        timestamp = note['timestamp']
+        if self.newest_timestamp is None or timestamp > self.newest_timestamp:
+            self.newest_timestamp = timestamp
+            self.newest_note_keys = set()
+        if timestamp == self.newest_timestamp:
+            self.newest_note_keys.add(get_note_key(note))
 
     def filter_notes(self, filter_type):
-        assert len(self.cached_notes) > 0
-        for note in self.cached_notes:
+        for note in self.iter_notes():
             if not filter_type or note['type'] == filter_type:
                 yield note
 
 
+def join_author_replies(reply_texts: List[str]) -> str:
+    # the whole reply of an author from their replies, newest first. A lone reply posted again counts once
+    reply_parts = reply_texts[:1]
+    for reply_text in islice(reply_texts, 1, None):
+        if len(reply_parts) == 1 and reply_parts[0] == reply_text:
+            continue
+        reply_parts.append(reply_text)
+    return "\n".join(reply_parts)
+
+
+def group_replies_by_author(replies: Iterable[dict],
+                            author_replies: Optional[Dict[str, List[str]]] = None) -> Iterator[Tuple[str, str]]:
+    # Yields an author with their whole reply every time it changes, only the replies themselves are kept.
+    # author_replies gets the reply texts of every author, newest first
+    if author_replies is None:
+        author_replies = dict()
+    for reply in replies:
+        reply_author = reply['blog_name']
+        reply_text = reply['reply_text']
+        reply_texts = author_replies.get(reply_author)
+        if reply_texts is None:
+            author_replies[reply_author] = [reply_text]
+            yield reply_author, reply_text
+            continue
+        reply_texts.append(reply_text)
+        if reply_texts.count(reply_text) == len(reply_texts):
+            continue
+        yield reply_author, join_author_replies(reply_texts)
+
+
+def merge_newer_replies(replies: Iterable[dict],
+                        author_replies: Dict[str, List[str]]) -> Iterator[Tuple[str, str]]:
+    # Replies newer than every one in author_replies, newest first, are put in front of the kept ones.
+    # Yields every author whose whole reply changed
+    newer_replies: Dict[str, List[str]] = dict()
+    for reply in replies:
+        newer_replies.setdefault(reply['blog_name'], []).append(reply['reply_text'])
+    for author, newer_texts in newer_replies.items():
+        reply_texts = author_replies.get(author)
+        previous_reply = join_author_replies(reply_texts) if reply_texts else None
+        reply_texts = author_replies[author] = newer_texts + (reply_texts or [])
+        reply = join_author_replies(reply_texts)
+        if reply != previous_reply:
+            yield author, reply
+
+
+@dataclass
+class ReviewGroup:
+    reply: str  # the first reply seen, it's the one shown for review
+    authors: Dict[str, str] = field(default_factory=dict)  # author -> their exact reply
+
+
+class ReviewQueue:
+    # Unknown replies grouped by compare text, so every distinct reply is reviewed once
+
+    def __init__(self):
+        self.__groups: Dict[str, ReviewGroup] = dict()
+        self.__author_texts: Dict[str, str] = dict()
+
+    def __len__(self):
+        return len(self.__groups)
+
+    @property
+    def replies_count(self) -> int:
+        return len(self.__author_texts)
+
+    def add(self, author: str, reply: str):
+        self.remove(author)
+        compare_text = get_compare_text(reply)
+        group = self.__groups.setdefault(compare_text, ReviewGroup(reply=reply))
+        group.authors[author] = reply
+        self.__author_texts[author] = compare_text
+
+    def remove(self, author: str):
+        compare_text = self.__author_texts.pop(author, None)
+        if compare_text is None:
+            return
+        group = self.__groups[compare_text]
+        del group.authors[author]
+        if not group.authors:
+            del self.__groups[compare_text]
+
+    def pop_groups(self) -> Iterator[ReviewGroup]:
+        while self.__groups:
+            compare_text = next(iter(self.__groups))
+            group = self.__groups.pop(compare_text)
+            for author in group.authors:
+                del self.__author_texts[author]
+            yield group
+
+
 class TumblrPost:
     @property
     def post_link(self):
         return self.post['post_url']
 
-    def __init__(self, client: TumblrRestClient, post: dict):
+    def __init__(self, client: TumblrApiClient, post: dict, notes_fetcher: Optional["AsyncNotesFetcher"] = None,
+                 notes_store: Optional["NotesStore"] = None, fuzzy_threshold: Optional[float] = None,
+                 options_database: Optional["VotesDatabase"] = None, show_options: bool = True):
         self.post = post
         self.votes = None
+        self.review_queue = ReviewQueue()
         self.__client = client
-
-        print("Getting initial choices...")
-        self.options = PostOptions(post)
-        self.options.print_current_options()
-
-    def count_votes(self, reset_cache: bool = False):
+        self.__notes_fetcher = notes_fetcher
+        self.__notes_store = notes_store
+        # kept by count_votes(keep_replies=True) for update_votes
+        self.__notes: Optional[PostNotes] = None
+        self.__author_replies: Optional[Dict[str, List[str]]] = None
+
+        if show_options:
+            print("Getting initial choices...")
+        self.options = PostOptions(post, fuzzy_threshold=fuzzy_threshold, database=options_database)
+        if show_options:
+            self.options.print_current_options()
+
+    def count_votes(self, reset_cache: bool = False, on_progress: Optional[Callable[[PostVotes], None]] = None,
+                    review: bool = True, keep_replies: bool = False):
+        # on_progress gets the partial tally after every page of notes.
+        # With review=False nothing is asked, unknown replies are left in review_queue for review_unknown_replies.
+        # With keep_replies the replies of every author are kept after the count, so update_votes can add new ones
         if self.votes and not reset_cache:
             return self.votes
 
-        notes = PostNotes(self.__client, self.post)
-        print(f"Cached {len(notes.cached_notes)} notes for post {self.post_link} "
-              f"({notes.notes_request_mode} mode)")
-
         self.votes = PostVotes(self.options.options)
-        replies = dict()
-
-        print("\nCounting votes...")
-        for reply in notes.filter_notes(filter_type='reply'):
-            reply_author = reply['blog_name']
-            reply_text = reply['reply_text']
-            if reply_author in replies:
-                if replies[reply_author] == reply_text:
-                    continue
-                replies[reply_author] += "\n"
-                replies[reply_author] += reply_text
-            else:
-                replies[reply_author] = reply_text
-        print(f"{len(replies)} replies to handle")
+        self.review_queue = ReviewQueue()
+
+        def report_progress():
+            if on_progress:
+                on_progress(self.votes)
+
+        notes = PostNotes(self.__client, self.post, notes_fetcher=self.__notes_fetcher,
+                          notes_store=self.__notes_store, on_page=report_progress)
+        author_replies = dict()
+        match_reply = METRICS.timed(self.options.match_reply, "classify_reply")
+        print(f"\nCounting votes for post {self.post_link} ({notes.notes_request_mode} mode)...")
+        for author, reply in group_replies_by_author(notes.filter_notes(filter_type='reply'), author_replies):
+            # nothing stops the fetch, replies that are unknown (or ambiguous) are asked about after it
+            self.__set_reply(author, reply, match_reply)
+        assert notes.notes_count > 0
+        METRICS.count("notes", notes.notes_count)
+        METRICS.count("notes_fetched", notes.fetched_notes_count)
+        METRICS.count("replies", self.votes.voters_count + self.review_queue.replies_count)
+        METRICS.count("unknown_replies", self.review_queue.replies_count)
+        print(f"Handled {notes.notes_count} notes ({notes.fetched_notes_count} fetched), "
+              f"{self.votes.voters_count + self.review_queue.replies_count} replies, "
+              f"{len(self.review_queue)} unknown")
+        if keep_replies:
+            self.__notes = notes
+            self.__author_replies = author_replies
+        else:
+            self.__notes = self.__author_replies = None
+
+        if review:
+            with METRICS.timer("review"):
+                self.review_unknown_replies()
 
+        return self.votes
+
+    def update_votes(self) -> int:
+        # Adds the notes posted since the last count or update to the tally, the known ones aren't fetched again.
+        # The vote of an author who replied again is counted anew from all their replies.
+        # Unknown replies go to review_queue. Returns the amount of new notes
+        assert self.__notes is not None, "update_votes needs count_votes(keep_replies=True) first"
+        notes_count = self.__notes.notes_count
+        match_reply = METRICS.timed(self.options.match_reply, "classify_reply")
+        with METRICS.timer("votes_update"):
+            new_replies = (note for note in self.__notes.iter_new_notes() if note['type'] == 'reply')
+            for author, reply in merge_newer_replies(new_replies, self.__author_replies):
+                self.__set_reply(author, reply, match_reply)
+        new_notes_count = self.__notes.notes_count - notes_count
+        METRICS.count("notes", new_notes_count)
+        return new_notes_count
+
+    def __set_reply(self, author: str, reply: str, match_reply: Callable[[str], Optional[str]]):
+        reply_option = match_reply(reply)
+        if reply_option:
+            self.review_queue.remove(author)
+            self.votes.set_vote(reply_option, author)
+        else:
+            self.votes.remove_vote(author)
+            self.review_queue.add(author, reply)
+
+    def review_unknown_replies(self):
+        # Asks once per distinct reply, only the votes of its authors are updated.
+        # New aliases are saved in one write at the end
         print("\nCalculating results...")
-        for author, reply in replies.items():
-            reply_option = self.options.get_option_for_reply(reply)
-            self.votes.add_vote(reply_option, author, reply)
+        added_aliases = 0
+        for group in self.review_queue.pop_groups():
+            # an alias added earlier in the review might match it already
+            reply_option = self.options.match_reply(group.reply)
+            if not reply_option:
+                reply_option = self.options.ask_option_for_reply(group.reply)
+                self.options.add_alias(reply_option, group.reply)
+                added_aliases += 1
+            for author in group.authors:
+                self.votes.set_vote(reply_option, author)
+        if added_aliases:
+            self.options.save()
 
         print("\nUpdated choices:")
         self.options.print_current_options()
 
-        return self.votes
+
+@dataclass
+class BatchResult:
+    posts: List[TumblrPost] = field(default_factory=list)  # counted posts, newest first
+    errors: List[Tuple[int, str]] = field(default_factory=list)  # (post id, error) for posts that failed
 
 
 class TumblrCounter:
+    POSTS_PAGE_SIZE = 20  # the most the API returns at once
 
-    def __init__(self, config):
+    def __init__(self, config, database_config=None):
         self.config = config
-        self.client = TumblrRestClient(config.key)
+        self.database_config = database_config
+        # one client for the whole run, everything shares its connections and its rate limit
+        self.client = TumblrApiClient.from_config(config)
+        self.notes_fetcher = None
+        if "notes_concurrency" in self.config and self.config.notes_concurrency > 1:
+            from notes_fetcher import AsyncNotesFetcher
+            self.notes_fetcher = AsyncNotesFetcher(config.key, host=self.client.host,
+                                                   concurrency=self.config.notes_concurrency,
+                                                   max_retries=self.client.max_retries, backoff=self.client.backoff,
+                                                   rate_limiter=self.client.rate_limiter,
+                                                   metrics=self.client.metrics, timeout=self.client.timeout)
+        self.database = None
+        self.notes_store = None
+        if "notes_cache" in self.config and self.config.notes_cache:
+            from database.helper import NotesStore
+            self.notes_store = NotesStore(self.get_database())
+        self.options_database = None
+        if "options_in_database" in self.config and self.config.options_in_database:
+            self.options_database = self.get_database()
+        self.fuzzy_threshold = None
+        if "fuzzy_threshold" in self.config:
+            self.fuzzy_threshold = self.config.fuzzy_threshold
+
+    def get_database(self) -> "VotesDatabase":
+        # one engine for everything the counter keeps in the database
+        if not self.database:
+            from database.helper import VotesDatabase
+            self.database = VotesDatabase(config=self.database_config)
+        return self.database
 
     def get_post_by_config(self) -> TumblrPost:
         print("Getting post...")
+        return self.create_post(self.fetch_post_by_config())
+
+    def get_post_by_link(self, link: str) -> TumblrPost:
+        return self.create_post(self.fetch_post_by_link(link))
+
+    def get_latest_post(self, blog: str) -> TumblrPost:
+        return self.create_post(self.fetch_latest_post(blog))
+
+    def fetch_post_by_config(self) -> dict:
         if "post_link" in self.config and self.config.post_link:
-            return self.get_post_by_link(self.config.post_link)
+            return self.fetch_post_by_link(self.config.post_link)
         else:
-            return self.get_latest_post(self.config.blog)
+            return self.fetch_latest_post(self.config.blog)
 
-    def get_post_by_link(self, link: str) -> TumblrPost:
+    def fetch_post_by_link(self, link: str) -> dict:
         blog, post_id = self.__get_post_info_from_link(link)
-        request = self.client.posts(blogname=blog, id=post_id)
+        with METRICS.timer("post_fetch"):
+            request = self.client.posts(blogname=blog, id=post_id)
         assert len(request['posts']) == 1
-        post = request['posts'][0]
-        return TumblrPost(self.client, post)
+        return request['posts'][0]
 
-    def get_latest_post(self, blog: str) -> TumblrPost:
-        request = self.client.posts(blogname=blog)
+    def fetch_latest_post(self, blog: str) -> dict:
+        with METRICS.timer("post_fetch"):
+            request = self.client.posts(blogname=blog)
         assert len(request['posts']) > 0
-        post = request['posts'][0]
-        return TumblrPost(self.client, post)
+        return request['posts'][0]
+
+    def create_post(self, post: dict, show_options: bool = True) -> TumblrPost:
+        return TumblrPost(self.client, post, self.notes_fetcher, self.notes_store, self.fuzzy_threshold,
+                          self.options_database, show_options)
+
+    def iter_blog_posts(self, blog: str, after: Optional[int] = None,
+                        before: Optional[int] = None) -> Iterator[dict]:
+        # Poll posts of the blog, newest first, published in [after, before) if those are set
+        offset = 0
+        while True:
+            with METRICS.timer("post_fetch"):
+                request = self.client.posts(blogname=blog, offset=offset, limit=self.POSTS_PAGE_SIZE)
+            posts = request['posts']
+            for post in posts:
+                if before is not None and post['timestamp'] >= before:
+                    continue
+                if after is not None and post['timestamp'] < after:
+                    return
+                if is_poll_post(post):
+                    yield post
+            if len(posts) < self.POSTS_PAGE_SIZE:
+                return
+            offset += len(posts)
+
+    def count_blog_posts(self, blog: str, after: Optional[int] = None, before: Optional[int] = None,
+                         workers: int = 4, review: bool = True) -> BatchResult:
+        # Posts are counted by a pool of workers sharing the client, the database and its options cache.
+        # Unknown replies are reviewed post by post once everything is counted,
+        # then all the counts are written to the database at once
+        def count_post(post: dict) -> TumblrPost:
+            tumblr_post = self.create_post(post, show_options=False)
+            tumblr_post.count_votes(review=False)
+            return tumblr_post
+
+        result = BatchResult()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                (post['id'], executor.submit(count_post, post))
+                for post in self.iter_blog_posts(blog, after, before)
+            ]
+            for post_id, future in futures:
+                try:
+                    result.posts.append(future.result())
+                except Exception as error:
+                    result.errors.append((post_id, repr(error)))
+                    print(f"Couldn't count post {post_id}: {error!r}")
+
+        METRICS.count("batch_posts", len(result.posts))
+        METRICS.count("batch_errors", len(result.errors))
+        if review:
+            for tumblr_post in result.posts:
+                if len(tumblr_post.review_queue):
+                    print(f"\nReviewing post {tumblr_post.post_link}")
+                    tumblr_post.options.print_current_options()
+                    tumblr_post.review_unknown_replies()
+
+        posts_votes = {tumblr_post.post['id']: tumblr_post.votes for tumblr_post in result.posts}
+        database = self.get_database()
+        database.save_vote_counts(
+            (post_id, option, votes_count)
+            for post_id, votes in posts_votes.items()
+            for option, votes_count in votes.counts().items()
+        )
+        database.save_post_votes(posts_votes.keys(), iter_vote_rows(posts_votes))
+        return result
 
     @staticmethod
     def __get_post_info_from_link(link: str) -> [str, str]:
@@ -0,0 +1,190 @@
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import METRICS
+
+
+class TumblrApiError(Exception):
+
+    def __init__(self, status: int, message: str):
+        super().__init__(f"Tumblr API error {status}: {message}")
+        self.status = status
+
+
+class TokenBucket:
+    # Thread-safe rate limiter, rate is in requests per second.
+    # reserve() takes a token and returns how long to wait for it, so asyncio code can share the bucket
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.__tokens = capacity
+        self.__updated = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def reserve(self) -> float:
+        with self.__lock:
+            now = time.monotonic()
+            self.__tokens = min(self.capacity, self.__tokens + (now - self.__updated) * self.rate)
+            self.__updated = now
+            # tokens go below zero for requests that are already waiting
+            self.__tokens -= 1
+            if self.__tokens >= 0:
+                return 0.0
+            return -self.__tokens / self.rate
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class RequestMetrics:
+    # Request counts and latency per endpoint, shared by everything that talks to the API
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.requests: Dict[str, int] = defaultdict(int)
+        self.statuses: Dict[int, int] = defaultdict(int)
+        self.retries = 0
+        self.cache_hits = 0
+        self.total_latency: Dict[str, float] = defaultdict(float)
+        self.max_latency: Dict[str, float] = defaultdict(float)
+
+    def record_request(self, endpoint: str, status: int, latency: float):
+        with self.__lock:
+            self.requests[endpoint] += 1
+            self.statuses[status] += 1
+            self.total_latency[endpoint] += latency
+            self.max_latency[endpoint] = max(self.max_latency[endpoint], latency)
+        METRICS.count(f"api_requests.{endpoint}")
+        METRICS.observe(f"api_request.{endpoint}", latency)
+
+    def record_retry(self):
+        with self.__lock:
+            self.retries += 1
+        METRICS.count("api_retries")
+
+    def record_cache_hit(self):
+        with self.__lock:
+            self.cache_hits += 1
+        METRICS.count("api_cache_hits")
+
+    def snapshot(self) -> dict:
+        with self.__lock:
+            return {
+                "requests": dict(self.requests),
+                "statuses": dict(self.statuses),
+                "retries": self.retries,
+                "cache_hits": self.cache_hits,
+                "mean_latency": {
+                    endpoint: self.total_latency[endpoint] / count for endpoint, count in self.requests.items()
+                },
+                "max_latency": dict(self.max_latency),
+            }
+
+    def summary(self) -> str:
+        snapshot = self.snapshot()
+        endpoints = ", ".join(
+            f"{endpoint} {count} ({snapshot['mean_latency'][endpoint] * 1000:.0f} ms avg)"
+            for endpoint, count in snapshot["requests"].items()
+        )
+        return (f"{sum(snapshot['requests'].values())} requests: {endpoints or 'none'}, "
+                f"{snapshot['retries']} retries, {snapshot['cache_hits']} cache hits")
+
+
+class TumblrApiClient:
+    # Drop-in for the TumblrRestClient calls the counter makes (posts and notes), over one keep-alive session.
+    # Requests go through a token bucket, 429 and 5xx responses are retried with backoff,
+    # posts lookups are cached for posts_cache_ttl seconds
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, api_key: str, host: str = "https://api.tumblr.com", requests_per_hour: float = 1000,
+                 burst: float = 50, max_retries: int = 5, backoff: float = 1.0, posts_cache_ttl: float = 60,
+                 pool_size: int = 10, timeout: float = 30):
+        self.api_key = api_key
+        self.host = host.rstrip("/")
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.posts_cache_ttl = posts_cache_ttl
+        self.timeout = timeout
+        self.rate_limiter = TokenBucket(requests_per_hour / 3600, burst)
+        self.metrics = RequestMetrics()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self.__posts_cache: Dict[Tuple, Tuple[float, dict]] = dict()
+        self.__cache_lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config) -> "TumblrApiClient":
+        # config is the [tumblr] section, everything but the key is optional
+        options = dict()
+        for option in ("host", "requests_per_hour", "burst", "max_retries", "backoff", "posts_cache_ttl",
+                       "pool_size", "timeout"):
+            if f"api_{option}" in config:
+                options[option] = config[f"api_{option}"]
+        return cls(config.key, **options)
+
+    def posts(self, blogname: str, **params) -> dict:
+        cache_key = (blogname, tuple(sorted(params.items())))
+        now = time.monotonic()
+        with self.__cache_lock:
+            cached = self.__posts_cache.get(cache_key)
+            if cached is not None and cached[0] > now:
+                self.metrics.record_cache_hit()
+                return cached[1]
+        response = self.get(f"/v2/blog/{blogname}/posts", params, endpoint="posts")
+        with self.__cache_lock:
+            # expired entries are dropped on the way
+            self.__posts_cache = {key: entry for key, entry in self.__posts_cache.items() if entry[0] > now}
+            self.__posts_cache[cache_key] = (now + self.posts_cache_ttl, response)
+        return response
+
+    def notes(self, blogname: str, id: str, **params) -> dict:
+        return self.get(f"/v2/blog/{blogname}/notes", dict(params, id=id), endpoint="notes")
+
+    def get(self, path: str, params: dict, endpoint: Optional[str] = None) -> dict:
+        params = dict(params, api_key=self.api_key)
+        endpoint = endpoint or path
+        attempt = 0
+        while True:
+            self.rate_limiter.acquire()
+            started = time.perf_counter()
+            try:
+                response = self.session.get(self.host + path, params=params, timeout=self.timeout)
+            except requests.ConnectionError:
+                if attempt >= self.max_retries:
+                    raise
+                response = None
+            else:
+                self.metrics.record_request(endpoint, response.status_code, time.perf_counter() - started)
+                if response.status_code not in self.RETRY_STATUSES or attempt >= self.max_retries:
+                    return self.__parse_response(response)
+            self.metrics.record_retry()
+            time.sleep(self.__get_retry_delay(response, attempt))
+            attempt += 1
+
+    def __get_retry_delay(self, response: Optional[requests.Response], attempt: int) -> float:
+        try:
+            return float(response.headers["Retry-After"])
+        except (AttributeError, KeyError, ValueError):
+            return self.backoff * 2 ** attempt
+
+    @staticmethod
+    def __parse_response(response: requests.Response) -> dict:
+        try:
+            data = response.json()
+        except ValueError:
+            raise TumblrApiError(response.status_code, "Malformed JSON or HTML was returned")
+        if not 200 <= response.status_code <= 399:
+            raise TumblrApiError(response.status_code, data.get('meta', dict()).get('msg', response.reason))
+        return data['response']
@@ -1,15 +1,115 @@
+import sys
+from array import array
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+NO_VOTE = -1
+
 
 class PostVotes:
-    def __init__(self, options: [str]):
-        self.votes = dict()
-        for option in options:
-            self.votes[option] = list()
+    # Votes are kept as columns: every author gets an id (their name is interned),
+    # their vote is an index into options, reply texts aren't kept
+    __slots__ = ("options", "__option_indices", "__author_ids", "__authors", "__author_options", "__counts",
+                 "__voters_count")
+
+    def __init__(self, options: Iterable[str]):
+        self.options: Tuple[str, ...] = tuple(options)
+        self.__option_indices = {option: index for index, option in enumerate(self.options)}
+        self.__author_ids: Dict[str, int] = dict()
+        self.__authors: List[str] = list()
+        self.__author_options = array("h")  # author id -> option index or NO_VOTE
+        self.__counts = array("l", [0] * len(self.options))
+        self.__voters_count = 0
+
+    @property
+    def voters_count(self) -> int:
+        return self.__voters_count
+
+    def add_vote(self, option: str, vote_author: str):
+        assert option in self.__option_indices
+        author_id = self.__get_author_id(vote_author)
+        assert self.__author_options[author_id] == NO_VOTE
+        option_index = self.__option_indices[option]
+        self.__author_options[author_id] = option_index
+        self.__counts[option_index] += 1
+        self.__voters_count += 1
+
+    def set_vote(self, option: str, vote_author: str):
+        # replaces the previous vote of the author, if there's one
+        self.remove_vote(vote_author)
+        self.add_vote(option, vote_author)
+
+    def remove_vote(self, vote_author: str):
+        author_id = self.__author_ids.get(vote_author)
+        if author_id is None:
+            return
+        option_index = self.__author_options[author_id]
+        if option_index != NO_VOTE:
+            self.__author_options[author_id] = NO_VOTE
+            self.__counts[option_index] -= 1
+            self.__voters_count -= 1
+
+    def get_vote(self, vote_author: str) -> Optional[str]:
+        author_id = self.__author_ids.get(vote_author)
+        if author_id is None or self.__author_options[author_id] == NO_VOTE:
+            return None
+        return self.options[self.__author_options[author_id]]
 
-    def add_vote(self, option: str, vote_author: str, vote: str):
-        assert option in self.votes
-        self.votes[option].append((vote, vote_author))
+    def counts(self) -> Dict[str, int]:
+        # option -> amount of votes
+        return dict(zip(self.options, self.__counts))
+
+    def columns(self) -> Tuple[List[str], array]:
+        # voters and indices of their options, for bulk exports
+        authors = list()
+        option_indices = array("h")
+        for author, option_index in zip(self.__authors, self.__author_options):
+            if option_index != NO_VOTE:
+                authors.append(author)
+                option_indices.append(option_index)
+        return authors, option_indices
+
+    def iter_votes(self) -> Iterator[Tuple[str, str]]:
+        # (author, option) for every voter
+        authors, option_indices = self.columns()
+        for author, option_index in zip(authors, option_indices):
+            yield author, self.options[option_index]
+
+    def __get_author_id(self, vote_author: str) -> int:
+        author_id = self.__author_ids.get(vote_author)
+        if author_id is None:
+            author_id = len(self.__authors)
+            vote_author = sys.intern(vote_author)
+            self.__author_ids[vote_author] = author_id
+            self.__authors.append(vote_author)
+            self.__author_options.append(NO_VOTE)
+        return author_id
 
 
 def format_reply(line: str, prefix: str = "- ") -> str:
     line = line.replace("\n", " ⮒ ")
     return f"{prefix}{line}"
+
+
+def format_counts(counts: dict) -> str:
+    return ", ".join(
+        [
+            f'{option} - {option_votes}'
+            for option, option_votes in counts.items()
+            if option_votes and option != "0"
+        ]
+    )
+
+
+def get_timestamp(value) -> Optional[int]:
+    # config dates can be unix timestamps, TOML dates and datetimes or ISO strings,
+    # command line and daemon requests pass unix timestamps as strings as well
+    if value is None or isinstance(value, int):
+        return value
+    if isinstance(value, str):
+        if value.strip().isdigit():
+            return int(value)
+        value = datetime.fromisoformat(value)
+    if not isinstance(value, datetime):
+        value = datetime(value.year, value.month, value.day)
+    return int(value.timestamp())
@@ -0,0 +1,38 @@
+import csv
+from typing import Dict, Iterator, Tuple
+
+from utils import PostVotes
+
+VOTE_COLUMNS = ("post_id", "blog_name", "vote_index")
+
+
+def iter_vote_rows(posts_votes: Dict[int, PostVotes]) -> Iterator[Tuple[int, str, int]]:
+    # (post id, voter, vote index) rows, the same as the post_votes table has
+    for post_id, votes in posts_votes.items():
+        authors, option_indices = votes.columns()
+        vote_indices = [int(option) for option in votes.options]
+        for author, option_index in zip(authors, option_indices):
+            yield post_id, author, vote_indices[option_index]
+
+
+def export_votes_csv(path: str, posts_votes: Dict[int, PostVotes]):
+    with open(path, "w", encoding="utf8", newline="") as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(VOTE_COLUMNS)
+        writer.writerows(iter_vote_rows(posts_votes))
+
+
+def export_votes_parquet(path: str, posts_votes: Dict[int, PostVotes]):
+    # pyarrow is optional, it's only needed for this export
+    import pyarrow
+    import pyarrow.parquet
+
+    rows = list(iter_vote_rows(posts_votes))
+    post_ids, blog_names, vote_indices = zip(*rows) if rows else ((), (), ())
+    table = pyarrow.table({
+        "post_id": pyarrow.array(post_ids, type=pyarrow.int64()),
+        # few distinct voters over many posts
+        "blog_name": pyarrow.array(blog_names, type=pyarrow.string()).dictionary_encode(),
+        "vote_index": pyarrow.array(vote_indices, type=pyarrow.int16()),
+    })
+    pyarrow.parquet.write_table(table, path)
@@ -0,0 +1,96 @@
+import json
+import os
+import threading
+import time
+from typing import Optional, TYPE_CHECKING
+
+from metrics import METRICS, serve_body
+from utils import format_counts
+
+if TYPE_CHECKING:
+    from tumblr import TumblrPost
+
+
+class PollWatcher:
+    # Keeps the tally of a running poll up to date: one full count, then only the new notes are fetched
+    # and added to it. Checks come every min_interval seconds while notes come and get rarer up to
+    # max_interval while nothing happens. Results are written to output_path and served on http_port.
+    # Nothing is asked, unknown replies are only counted
+
+    def __init__(self, tumblr_post: "TumblrPost", min_interval: float = 5.0, max_interval: float = 120.0,
+                 backoff: float = 1.5, output_path: Optional[str] = None, http_port: Optional[int] = None):
+        self.tumblr_post = tumblr_post
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.output_path = output_path
+        self.http_port = http_port
+        self.interval = min_interval
+        self.checked_at: Optional[float] = None
+        self.changed_at: Optional[float] = None
+        self.__published = b"{}"
+        self.__stop = threading.Event()
+
+    def run(self):
+        # until stop() or Ctrl+C
+        server = None
+        if self.http_port:
+            # the latest results on any path
+            server = serve_body(self.http_port, lambda: self.__published, "application/json; charset=utf-8")
+        try:
+            self.tumblr_post.count_votes(reset_cache=True, review=False, keep_replies=True)
+            self.checked_at = self.changed_at = time.time()
+            self.publish()
+            while not self.__stop.wait(self.interval):
+                self.check()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if server:
+                server.shutdown()
+                server.server_close()
+
+    def stop(self):
+        self.__stop.set()
+
+    def check(self) -> int:
+        # One update of the tally, the interval is adjusted by it. Returns the amount of new notes
+        METRICS.count("watch_checks")
+        try:
+            new_notes_count = self.tumblr_post.update_votes()
+        except Exception as error:
+            # the next check gets the notes missed by this one
+            METRICS.count("watch_errors")
+            print(f"Couldn't check post {self.tumblr_post.post_link}: {error!r}")
+            new_notes_count = 0
+        self.checked_at = time.time()
+        if new_notes_count:
+            self.changed_at = self.checked_at
+            self.interval = self.min_interval
+            print(f"{new_notes_count} new notes: {format_counts(self.tumblr_post.votes.counts())}")
+        else:
+            self.interval = min(self.interval * self.backoff, self.max_interval)
+        self.publish()
+        return new_notes_count
+
+    def snapshot(self) -> dict:
+        votes = self.tumblr_post.votes
+        return {
+            "post": self.tumblr_post.post_link,
+            "counts": votes.counts(),
+            "voters": votes.voters_count,
+            "unknown": self.tumblr_post.review_queue.replies_count,
+            "checked_at": self.checked_at,
+            "changed_at": self.changed_at,
+            "next_check_in": self.interval,
+        }
+
+    def publish(self):
+        with METRICS.timer("watch_publish"):
+            self.__published = json.dumps(self.snapshot(), ensure_ascii=False).encode("utf8")
+            if self.output_path:
+                # readers never see a half-written file
+                temporary_path = self.output_path + ".tmp"
+                with open(temporary_path, "wb") as output_file:
+                    output_file.write(self.__published)
+                os.replace(temporary_path, self.output_path)